@@ -0,0 +1,34 @@
+# ==========
+# Measures how long it takes to import Helipad in a fresh interpreter,
+# and checks that none of the slow optional modules are pulled in.
+# Run from the repository root: python benchmarks/importtime.py [repeats]
+# ==========
+
+import subprocess, sys, os, statistics
+
+heavy = ['pandas', 'matplotlib', 'tkinter', 'networkx']
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+script = '''
+import sys, time
+sys.path.insert(0, {root!r})
+start = time.perf_counter()
+import helipad
+print(time.perf_counter()-start)
+print(','.join(m for m in {heavy!r} if m in sys.modules))
+'''.format(root=root, heavy=heavy)
+
+def importTime():
+	out = subprocess.run([sys.executable, '-c', script], capture_output=True, text=True, check=True).stdout.split('\n')
+	return float(out[0]), [m for m in out[1].split(',') if m]
+
+if __name__ == '__main__':
+	repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+	times = []
+	for i in range(repeats):
+		t, loaded = importTime()
+		times.append(t)
+	
+	print('Import time over',repeats,'runs: median',round(statistics.median(times)*1000,1),'ms, min',round(min(times)*1000,1),'ms')
+	if loaded:
+		print('Slow modules loaded on import:', ', '.join(loaded))
+		sys.exit(1)
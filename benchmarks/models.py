@@ -0,0 +1,118 @@
+# ==========
+# Runs the sample models headless at several population sizes, and records periods per second,
+# time to the end of the first period (including setup), and peak memory for each. Each configuration is run
+# several times and the medians are recorded (the fastest for the first period, which is short enough that
+# noise only ever slows it down), so a single noisy run doesn't show up as a regression.
+# Each run gets a fresh interpreter, so memory and module state don't carry over.
+# Run from the repository root:
+#   python benchmarks/models.py --save baseline.json		Record a baseline
+#   python benchmarks/models.py --compare baseline.json		Flag regressions against it
+# See --help for the rest of the options.
+# ==========
+
+import subprocess, sys, os, json, argparse
+from statistics import median
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+models = ['Helicopter.py', 'Helicopter-OMO.py', 'Cities.py', 'pricediscover.py', 'spatial.py']
+
+#Run in the child process. Loads the model without launching the GUI, and sets the population
+#in a modelPreSetup hook so it overrides any the model sets itself.
+script = '''
+import sys, time, json, runpy
+sys.path.insert(0, {root!r})
+heli = runpy.run_path({path!r}, run_name='benchmark')['heli']
+def population(model): model.param('agents_agent', {size})
+heli.addHook('modelPreSetup', population)
+heli.seed(0)
+
+start = time.perf_counter()
+heli.setup()
+heli.step()
+first = time.perf_counter() - start
+start = time.perf_counter()
+heli.run({periods}-1)
+elapsed = time.perf_counter() - start
+
+try:
+	import resource
+	peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform=='darwin' else 1024)
+except ImportError: peak = None
+print(json.dumps({{'periods': heli.t, 'rate': (heli.t-1)/elapsed if heli.t > 1 else None, 'first': first, 'memory': peak}}))
+'''
+
+def bench(model, size, periods, timeout=None):
+	path = os.path.join(root, 'sample-models', model)
+	code = script.format(root=root, path=path, size=size, periods=periods)
+	try: proc = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, timeout=timeout)
+	except subprocess.TimeoutExpired: return {'error': 'Timed out'}
+	if proc.returncode: return {'error': proc.stderr.strip().split('\n')[-1]}
+	return json.loads(proc.stdout.strip().split('\n')[-1])
+
+#Run a configuration several times and keep the median rate and memory use, and the fastest first period
+def repeat(model, size, periods, repeats, timeout=None):
+	runs = []
+	for i in range(repeats):
+		r = bench(model, size, periods, timeout)
+		if 'error' in r: return r
+		runs.append(r)
+	
+	def summarize(metric, f):
+		vals = [r[metric] for r in runs if r[metric] is not None]
+		return f(vals) if vals else None
+	return {
+		'periods': runs[0]['periods'],
+		'repeats': repeats,
+		'rate': summarize('rate', median),
+		'first': summarize('first', min),
+		'memory': summarize('memory', median)
+	}
+
+#Returns a list of strings describing each metric that got worse by more than threshold (a proportion)
+def compare(baseline, results, threshold):
+	regressions = []
+	for key, new in results.items():
+		old = baseline.get(key)
+		if old is None or 'error' in old or 'error' in new: continue
+		checks = [('rate', 'periods/second', -1), ('first', 'time to first period', 1), ('memory', 'peak memory', 1)]
+		for metric, title, sign in checks:
+			if not old.get(metric) or new.get(metric) is None: continue
+			change = (new[metric] - old[metric]) / old[metric]
+			if sign*change > threshold:
+				regressions.append('{}: {} {:+.1%} ({:.4g} → {:.4g})'.format(key, title, change, old[metric], new[metric]))
+	return regressions
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Benchmark the sample models headless.')
+	parser.add_argument('--models', nargs='+', default=models)
+	parser.add_argument('--sizes', nargs='+', type=int, default=[100, 1000, 10000])
+	parser.add_argument('--periods', type=int, default=100)
+	parser.add_argument('--repeats', type=int, default=5, help='Runs per configuration')
+	parser.add_argument('--timeout', type=float, default=600, help='Seconds before giving up on a run')
+	parser.add_argument('--save', metavar='FILE', help='Write the results to a JSON baseline')
+	parser.add_argument('--compare', metavar='FILE', help='Compare the results against a JSON baseline')
+	parser.add_argument('--threshold', type=float, default=0.1, help='Proportional change to flag as a regression')
+	args = parser.parse_args()
+
+	results = {}
+	for model in args.models:
+		for size in args.sizes:
+			key = model+' @ '+str(size)
+			r = results[key] = repeat(model, size, args.periods, args.repeats, args.timeout)
+			if 'error' in r: print('{:<30} {}'.format(key, r['error']))
+			else:
+				rate = '{:10.1f} periods/s'.format(r['rate']) if r['rate'] else '{:>21}'.format('–')
+				memory = '{:8.1f} MB peak'.format(r['memory']/2**20) if r['memory'] else ''
+				print('{:<30} {} {:9.3f}s to first period {}'.format(key, rate, r['first'], memory))
+
+	if args.save:
+		with open(args.save, 'w') as f: json.dump(results, f, indent=2)
+
+	if args.compare:
+		with open(args.compare) as f: baseline = json.load(f)
+		regressions = compare(baseline, results, args.threshold)
+		if regressions:
+			print('\nRegressions beyond {:.0%}:'.format(args.threshold))
+			for r in regressions: print('  '+r)
+			sys.exit(1)
+		else: print('\nNo regressions beyond {:.0%}.'.format(args.threshold))
@@ -3,7 +3,7 @@
 # Do not run this file; import model.py and run from your file.
 # ==========
 
-from random import choice
+from collections.abc import MutableMapping
 from numpy import *
 
 #Basic agent functions. This class should not be instantiated directly; instead it should be
@@ -11,98 +11,116 @@ from numpy import *
 #See below, the Agent() class for a minimal example.
 class baseAgent():
 	def __init__(self, breed, id, model):
+		#Claim a row before setting any tracked attributes
+		self.ledger = model.ledgers.get(self.primitive)
+		if self.ledger is not None: self.ledgerRow = self.ledger.open(self)
+		
 		self.breed = breed
 		self.id = int(id)
 		self.model = model
 		self.age = 0
 		self.dead = False
-		self.goods = {}
 		self.edges = {}
 		self.utils = 0
+		
+		if self.ledger is not None and self.ledger.goodsList is not None:
+			self.goods, self.currentDemand, self.currentShortage = self.ledger.views(self.ledgerRow)
+		else:
+			self.goods = {}
+			self.currentDemand = {g:0 for g in model.goods.keys()}
+			self.currentShortage = {g:0 for g in model.goods.keys()}
+		
 		for good, params in model.goods.items():
 			if params.endowment is None: self.goods[good] = 0
 			elif callable(params.endowment): self.goods[good] = params.endowment(self.breed if hasattr(self, 'breed') else None)
 			else: self.goods[good] = params.endowment
-		
-		self.currentDemand = {g:0 for g in model.goods.keys()}
-		self.currentShortage = {g:0 for g in model.goods.keys()}
 					
-		self.model.doHooks(['baseAgentInit', self.primitive+'Init'], [self, self.model])
+		hooks = self.model.dispatch[self.primitive]
+		if hooks.init: hooks.init(self, self.model)
 	
 	def step(self, stage):
-		self.model.doHooks(['baseAgentStep', self.primitive+'Step'], [self, self.model, stage])
+		hooks = self.model.dispatch[self.primitive]
+		if hooks.step: hooks.step(self, self.model, stage)
 		if stage == self.model.stages: self.age += 1
 	
 	#Give amt1 of good 1, get amt2 of good 2
 	#Negative values of amt1 and amt2 allowed, which reverses the direction
+	#If the partner is being stepped in another thread, the trade is deferred to the end of the stage. See Helipad.stepParallel()
 	def trade(self, partner, good1, amt1, good2, amt2):
-		self.model.doHooks('preTrade', [self, partner, good1, amt1, good2, amt2])
-		
-		if amt2 != 0: price = amt1 / amt2
-		
-		#Budget constraints. Hold price constant if hit		
-		if amt1 > self.goods[good1]:
-			self.currentShortage[good1] += amt1 - self.goods[good1]
-			amt1 = self.goods[good1]
-			if amt2 != 0: amt2 = amt1 / price
-		elif -amt1 > partner.goods[good1]:
-			partner.currentShortage[good1] += -amt1 - partner.goods[good1]
-			amt1 = -partner.goods[good1]
-			if amt2 != 0: amt2 = amt1 / price
-		if amt2 > partner.goods[good2]:
-			partner.currentShortage[good2] += amt1 - partner.goods[good2]
-			amt2 = partner.goods[good2]
-			amt1 = price * amt2
-		elif -amt2 > self.goods[good2]:
-			self.currentShortage[good2] += -amt1 - self.goods[good2]
-			amt2 = -self.goods[good2]
-			amt1 = price * amt2
+		if self.model.deferring(self, partner): return self.model.defer(self.trade, partner, good1, amt1, good2, amt2)
+		with self.model.transaction(self, partner):
+			hooks = self.model.dispatch[self.primitive]
+			if hooks.preTrade: hooks.preTrade(self, partner, good1, amt1, good2, amt2)
+			
+			if amt2 != 0: price = amt1 / amt2
+			
+			#Budget constraints. Hold price constant if hit		
+			if amt1 > self.goods[good1]:
+				self.currentShortage[good1] += amt1 - self.goods[good1]
+				amt1 = self.goods[good1]
+				if amt2 != 0: amt2 = amt1 / price
+			elif -amt1 > partner.goods[good1]:
+				partner.currentShortage[good1] += -amt1 - partner.goods[good1]
+				amt1 = -partner.goods[good1]
+				if amt2 != 0: amt2 = amt1 / price
+			if amt2 > partner.goods[good2]:
+				partner.currentShortage[good2] += amt1 - partner.goods[good2]
+				amt2 = partner.goods[good2]
+				amt1 = price * amt2
+			elif -amt2 > self.goods[good2]:
+				self.currentShortage[good2] += -amt1 - self.goods[good2]
+				amt2 = -self.goods[good2]
+				amt1 = price * amt2
 
-		self.goods[good1] -= amt1
-		partner.goods[good1] += amt1
-		self.goods[good2] += amt2
-		partner.goods[good2] -= amt2
-		
-		#Record demand
-		if amt1 > 0: partner.currentDemand[good1] += amt1
-		else: self.currentDemand[good1] -= amt1
-		if amt2 > 0: self.currentDemand[good2] += amt2
-		else: partner.currentDemand[good2] -= amt2
-		
-		self.model.doHooks('postTrade', [self, partner, good1, amt1, good2, amt2])
+			self.goods[good1] -= amt1
+			partner.goods[good1] += amt1
+			self.goods[good2] += amt2
+			partner.goods[good2] -= amt2
+			
+			#Record demand
+			if amt1 > 0: partner.currentDemand[good1] += amt1
+			else: self.currentDemand[good1] -= amt1
+			if amt2 > 0: self.currentDemand[good2] += amt2
+			else: partner.currentDemand[good2] -= amt2
+			
+			if hooks.postTrade: hooks.postTrade(self, partner, good1, amt1, good2, amt2)
 	
 	#Price is per-unit
 	#Returns the quantity actually sold, Which is the same as quantity input unless there's a shortage
 	def buy(self, partner, good, q, p):
 		if self.model.moneyGood is None: raise RuntimeError('Buy function requires a monetary good to be specified')
-		qp = self.model.doHooks('buy', [self, partner, good, q, p])
-		if qp is not None: q, p = qp
+		if self.model.deferring(self, partner): return self.model.deferResult(self.buy, partner, good, q, p)
+		hooks = self.model.dispatch[self.primitive]
+		if hooks.buy:
+			qp = hooks.buy(self, partner, good, q, p)
+			if qp is not None: q, p = qp
 		
-		before = self.goods[good]
-		self.trade(partner, self.model.moneyGood, p*q, good, q)
-		return self.goods[good] - before
+		with self.model.transaction(self, partner):
+			before = self.goods[good]
+			self.trade(partner, self.model.moneyGood, p*q, good, q)
+			return self.goods[good] - before
 	
 	#Unilateral
 	def pay(self, recipient, amount):
 		if self.model.moneyGood is None: raise RuntimeError('Pay function requires a monetary good to be specified')
-		
-		#Budget constraint and hooks
-		if amount > self.balance: amount = self.balance
-		if -amount > recipient.balance: amount = -recipient.balance
-		amount_ = self.model.doHooks('pay', [self, recipient, amount, self.model])
-		if amount_ is not None: amount = amount_
-				
-		if amount != 0:
-			recipient.goods[self.model.moneyGood] += amount
-			self.goods[self.model.moneyGood] -= amount
-		return amount
+		if self.model.deferring(self, recipient): return self.model.deferResult(self.pay, recipient, amount)
+		with self.model.transaction(self, recipient):
+			#Budget constraint and hooks
+			if amount > self.balance: amount = self.balance
+			if -amount > recipient.balance: amount = -recipient.balance
+			hooks = self.model.dispatch[self.primitive]
+			if hooks.pay:
+				amount_ = hooks.pay(self, recipient, amount, self.model)
+				if amount_ is not None: amount = amount_
+					
+			if amount != 0:
+				recipient.goods[self.model.moneyGood] += amount
+				self.goods[self.model.moneyGood] -= amount
+			return amount
 	
 	def reproduce(self, inherit=[], mutate={}, partners=[]):
-		maxid = 0
-		for a in self.model.agents['agent']:
-			if a.id > maxid:
-				maxid = a.id
-		newagent = type(self)(self.breed, maxid+1, self.model)
+		if self.model.foreign(): return self.model.defer(self.reproduce, inherit, mutate, partners)
+		newagent = type(self)(self.breed, self.model.nextID(), self.model)
 		
 		#Values in the inherit list can either be a variable name (in which case the new agent inherits
 		#the mean of all of the values for the parents), or a tuple, the first element of which is a
@@ -126,7 +144,7 @@ class baseAgent():
 			elif stat=='gmean': n = exp(log(v).sum()/len(v))
 			elif stat=='first': n = v[0]
 			elif stat=='last': n = v[len(v)-1]
-			elif stat=='rand' or stat=='random': n = choice(v)
+			elif stat=='rand' or stat=='random': n = self.model.random.choice(v)
 			elif stat=='max': n = max(v)
 			elif stat=='min': n = min(v)
 			elif callable(stat): n = stat(v)
@@ -144,25 +162,36 @@ class baseAgent():
 				if isinstance(v, tuple): v, scale = v
 				else: scale = 'linear'
 					
-				if scale=='log': newval = random.lognormal(log(getattr(newagent, k)), v)
-				else: newval = random.normal(getattr(newagent, k), v)
+				if scale=='log': newval = self.model.rng.lognormal(log(getattr(newagent, k)), v)
+				else: newval = self.model.rng.normal(getattr(newagent, k), v)
 			setattr(newagent, k, newval)
 		
-		newagent.id = maxid+1
 		for p in parents:
 			p.newEdge(newagent,'lineage', True) #Keep track of parent-child relationships
 		self.model.agents[self.primitive].append(newagent)
+		self.model.agentIndex[newagent.id] = newagent
 		self.model.param('agents_'+self.primitive, self.model.param('agents_'+self.primitive)+1)
 		
-		self.model.doHooks(['baseAgentReproduce', self.primitive+'Reproduce'], [parents, newagent, self.model])
+		hooks = self.model.dispatch[self.primitive]
+		if hooks.reproduce: hooks.reproduce(parents, newagent, self.model)
 		return newagent
 	
+	#The agent is removed from model.agents at the end of the stage. See Helipad.compact()
 	def die(self):
-		self.model.agents[self.primitive].remove(self)
+		if self.dead: return
+		if self.model.foreign(): return self.model.defer(self.die)
+		del self.model.agentIndex[self.id]
+		self.model.deaths[self.primitive] = self.model.deaths.get(self.primitive, 0) + 1
 		self.model.param('agents_'+self.primitive, self.model.param('agents_'+self.primitive)-1)
 		for edge in self.alledges: edge.cut()
-		self.model.doHooks(['baseAgentDie', self.primitive+'Die'], [self])
+		hooks = self.model.dispatch[self.primitive]
+		if hooks.die: hooks.die(self)
 		self.dead = True
+		
+		if self.ledger is not None:
+			detached = self.ledger.close(self.ledgerRow)
+			self.ledger = None
+			self.__dict__.update(detached)
 	
 	def newEdge(self, partner, kind='edge', direction=None, weight=1):
 		return Edge(self, partner, kind, direction, weight)
@@ -213,8 +242,10 @@ class baseAgent():
 	def balance(self):
 		if self.model.moneyGood is None: raise RuntimeError('Balance checking requires a monetary good to be specified')
 		bal = self.goods[self.model.moneyGood]
-		bal_ = self.model.doHooks('checkBalance', [self, bal, self.model])
-		if bal_ is not None: bal = bal_
+		hooks = self.model.dispatch[self.primitive]
+		if hooks.checkBalance:
+			bal_ = hooks.checkBalance(self, bal, self.model)
+			if bal_ is not None: bal = bal_
 		
 		return bal
 
@@ -273,4 +304,154 @@ class Edge():
 		self.vertices = (self.partner(oldagent), newagent)
 		oldagent.edges[self.kind].remove(self)
 		newagent.edges[self.kind].append(self)
-		newagent.model.doHooks('edgeReassign', [self, oldagent, newagent])
\ No newline at end of file
+		newagent.model.doHooks('edgeReassign', [self, oldagent, newagent])
+
+#Optional columnar storage for agents, one ledger per primitive. With model.useLedger = True, every agent's
+#goods, currentDemand, and currentShortage are kept in (agents × goods) arrays, and each agent gets dict-like
+#views onto its row, so agent.goods[good] works as usual. Attributes registered with Helipad.trackAttribute()
+#are kept in one array each, along with a column of breed codes, so reporters can be computed over a whole column.
+#Rows of dead agents are zeroed and reused, so sums over a whole column are sums over living agents.
+class Ledger():
+	columns = ('goods', 'currentDemand', 'currentShortage')
+	
+	#goods is None if only tracking attributes
+	def __init__(self, goods, attrs=[], breeds=[], size=64):
+		size = int(size) or 1
+		self.goodsList = None if goods is None else list(goods)
+		self.index = {} if goods is None else {g:i for i,g in enumerate(self.goodsList)}
+		if goods is not None:
+			for c in self.columns: setattr(self, c, zeros((size, len(self.goodsList))))
+		self.attrs = {a: zeros(size) for a in attrs}
+		self.breedList = list(breeds)
+		self.breedCodes = {b:i for i,b in enumerate(self.breedList)}
+		self.breed = zeros(size, dtype=int16)
+		self.live = zeros(size, dtype=bool)
+		self.agents = [None] * size
+		self.n = 0		#High-water mark
+		self.free = []	#Released rows below the high-water mark
+	
+	def open(self, agent):
+		if self.free: row = self.free.pop()
+		else:
+			if self.n == len(self.live): self.grow()
+			row = self.n
+			self.n += 1
+		self.live[row] = True
+		self.agents[row] = agent
+		return row
+	
+	#Views onto a row for the goods, currentDemand, and currentShortage of an agent
+	def views(self, row): return tuple(LedgerView(self, c, row) for c in self.columns)
+	
+	#Returns the contents of the row in a dict, so a dead agent can still be inspected after its row is reused
+	def close(self, row):
+		detached = {a: col[row] for a, col in self.attrs.items()}
+		detached['breed'] = self.breedList[self.breed[row]]
+		if self.goodsList is not None:
+			for c in self.columns:
+				detached[c] = {g: getattr(self, c)[row, i] for g,i in self.index.items()}
+				getattr(self, c)[row] = 0
+		for col in self.attrs.values(): col[row] = 0
+		self.live[row] = False
+		self.agents[row] = None
+		self.free.append(row)
+		return detached
+	
+	#Double the capacity
+	def grow(self):
+		size = len(self.live)
+		if self.goodsList is not None:
+			for c in self.columns: setattr(self, c, concatenate((getattr(self, c), zeros((size, len(self.goodsList))))))
+		for a, col in self.attrs.items(): self.attrs[a] = concatenate((col, zeros(size)))
+		self.breed = concatenate((self.breed, zeros(size, dtype=int16)))
+		self.live = concatenate((self.live, zeros(size, dtype=bool)))
+		self.agents += [None] * size
+	
+	#Zero out per-period variables
+	def reset(self):
+		self.currentDemand.fill(0)
+		self.currentShortage.fill(0)
+	
+	#Whether a column can be read directly, for agentReporter
+	def has(self, key, good=None):
+		return key in self.attrs if good is None else self.goodsList is not None and key in self.columns
+	
+	#An array of values across living agents, optionally of one breed
+	def column(self, key, good=None, breed=None):
+		mask = self.live[:self.n]
+		if breed is not None:
+			if breed not in self.breedCodes: return zeros(0)
+			mask = mask & (self.breed[:self.n] == self.breedCodes[breed])
+		col = self.attrs[key] if good is None else getattr(self, key)[:, self.index[good]]
+		return col[:self.n][mask]
+
+#Passed to [prim]StepVector hooks in place of stepping each agent. Columns are views onto the ledger,
+#one entry per row, so writing to them writes to the agents. Rows that aren't in use are zero, and
+#excluded by the live mask. The views are only valid until an agent is born or dies, so do those last.
+class LedgerFrame():
+	def __init__(self, ledger):
+		self.ledger = ledger
+		self.n = ledger.n
+		self.live = ledger.live[:self.n]
+		self.agents = ledger.agents[:self.n]	#The agent object in each row, or None
+	
+	#A tracked attribute
+	def __getitem__(self, attr): return self.ledger.attrs[attr][:self.n]
+	def __setitem__(self, attr, val): self.ledger.attrs[attr][:self.n] = val
+	
+	#One good from the goods, currentDemand, or currentShortage columns, if the model uses the goods ledger
+	def good(self, good, key='goods'): return getattr(self.ledger, key)[:self.n, self.ledger.index[good]]
+	
+	#Mask of the living agents of a breed
+	def breed(self, breed): return self.live & (self.ledger.breed[:self.n] == self.ledger.breedCodes[breed])
+	
+	#Change the breed of the agents selected by a mask
+	def setBreed(self, mask, breed): self.ledger.breed[:self.n][mask] = self.ledger.breedCodes[breed]
+
+class LedgerView(MutableMapping):
+	__slots__ = ('ledger', 'key', 'row')
+	def __init__(self, ledger, key, row):
+		self.ledger = ledger
+		self.key = key
+		self.row = row
+	
+	def __getitem__(self, good): return getattr(self.ledger, self.key)[self.row, self.ledger.index[good]]
+	def __setitem__(self, good, val): getattr(self.ledger, self.key)[self.row, self.ledger.index[good]] = val
+	def __delitem__(self, good): raise TypeError('Goods cannot be removed from an agent.')
+	def __iter__(self): return iter(self.ledger.goodsList)
+	def __len__(self): return len(self.ledger.goodsList)
+	def __contains__(self, good): return good in self.ledger.index
+	def __repr__(self): return repr(dict(self))
+
+#Installed on the agent class by Helipad.trackAttribute(). Reads and writes the agent's row in the ledger,
+#or the instance dict if the agent has no row – if it's dead, or belongs to a model not tracking the attribute.
+class TrackedAttribute():
+	def __init__(self, name): self.name = name
+	
+	def __get__(self, agent, cls=None):
+		if agent is None: return self
+		ledger = agent.__dict__.get('ledger')
+		if ledger is not None and self.name in ledger.attrs: return ledger.attrs[self.name][agent.ledgerRow]
+		try: return agent.__dict__[self.name]
+		except KeyError: raise AttributeError('\''+type(agent).__name__+'\' object has no attribute \''+self.name+'\'')
+	
+	def __set__(self, agent, val):
+		ledger = agent.__dict__.get('ledger')
+		if ledger is not None and self.name in ledger.attrs: ledger.attrs[self.name][agent.ledgerRow] = val
+		else: agent.__dict__[self.name] = val
+
+#Keeps the ledger's column of breed codes current, e.g. if an agent changes breed
+class TrackedBreed(TrackedAttribute):
+	def __init__(self): self.name = 'breed'
+	
+	def __get__(self, agent, cls=None):
+		if agent is None: return self
+		ledger = agent.__dict__.get('ledger')
+		if ledger is not None: return ledger.breedList[ledger.breed[agent.ledgerRow]]
+		try: return agent.__dict__['breed']
+		except KeyError: raise AttributeError('\''+type(agent).__name__+'\' object has no attribute \'breed\'')
+	
+	def __set__(self, agent, val):
+		ledger = agent.__dict__.get('ledger')
+		if ledger is not None: ledger.breed[agent.ledgerRow] = ledger.breedCodes[val]
+		else: agent.__dict__['breed'] = val
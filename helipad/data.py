@@ -3,22 +3,228 @@
 # Do not run this file; import model.py and run from your file.
 # ==========
 
-import pandas, os.path
+import os.path
+from time import perf_counter
 from numpy import *
 
+#A reporter's series, stored in a preallocated Numpy array that doubles when it fills up, so collecting a
+#period is a single write rather than a boxed float in a list. Numbers are stored as float64, with None as NaN;
+#the column falls back to an object array if a reporter returns anything non-numeric. Slices are views.
+class Column():
+	def __init__(self, values=(), size=64, start=0):
+		values = asarray(values)
+		self.n = len(values)
+		self.start = start		#Number of values dropped off the front after being written to a sink
+		self.buf = empty(int(self.n or size), dtype=object if values.dtype.kind in 'OUS' else float64)
+		self.buf[:self.n] = values
+	
+	def append(self, value):
+		if self.n == len(self.buf): self.reserve(2*self.n)
+		if self.buf.dtype != object:
+			if value is None: value = nan
+			elif not isinstance(value, (int, float, bool, number)):
+				self.buf = self.buf.astype(object)
+		self.buf[self.n] = value
+		self.n += 1
+	
+	#Grow the buffer to hold at least size values without reallocating
+	def reserve(self, size):
+		if size <= len(self.buf): return
+		buf = empty(size, dtype=self.buf.dtype)
+		buf[:self.n] = self.buf[:self.n]
+		self.buf = buf
+	
+	#Drop the first k values. Copies into a new buffer so views already handed out stay valid
+	def drop(self, k):
+		k = int(k if k < self.n else self.n)
+		if k <= 0: return
+		buf = empty(len(self.buf), dtype=self.buf.dtype)
+		buf[:self.n-k] = self.buf[k:self.n]
+		self.buf, self.n, self.start = buf, self.n-k, self.start+k
+	
+	@property
+	def values(self): return self.buf[:self.n]
+	
+	def __len__(self): return self.n
+	def __getitem__(self, index): return self.values[index]
+	def __iter__(self): return iter(self.values)
+	def __array__(self, dtype=None, copy=None): return self.values if dtype is None else self.values.astype(dtype)
+	def __repr__(self): return 'Column('+repr(self.values)+')'
+	
+	#Don't save the unused capacity
+	def __reduce__(self): return (Column, (self.values, 64, self.start))
+
+#A fixed-size window over the most recent n values of a series, with statistics updated as each value comes in,
+#so reading them costs the same however long the window. Variance and standard deviation are sample statistics,
+#as in Pandas. The mean and variance are recomputed from the window each time it wraps around to keep rounding
+#error from accumulating, and so a NaN stops counting soon after it leaves the window. Create with data.rolling().
+class Rolling():
+	def __init__(self, n, alpha=None):
+		from collections import deque
+		self.size = n
+		self.alpha = 2/(n+1) if alpha is None else alpha	#Smoothing factor for the exponential moving average
+		self.buf = empty(n)
+		self.lows, self.highs = deque(), deque()			#Monotonic queues of (index, value) for the min and max
+		self.clear()
+	
+	def clear(self):
+		self.count, self.pos, self.index = 0, 0, 0
+		self.mean, self.m2, self.ema = nan, 0, nan
+		self.lows.clear()
+		self.highs.clear()
+	
+	def append(self, x):
+		x = nan if x is None else float(x)
+		if self.count < self.size:
+			self.count += 1
+			if self.count==1: self.mean, self.ema = x, x
+			else:
+				d = x - self.mean
+				self.mean += d/self.count
+				self.m2 += d*(x - self.mean)
+		else:
+			old = self.buf[self.pos]
+			mean = self.mean + (x - old)/self.size
+			self.m2 += (x - old)*(x - mean + old - self.mean)
+			self.mean = mean
+		if self.index > 0: self.ema = self.alpha*x + (1-self.alpha)*self.ema
+		self.buf[self.pos] = x
+		
+		#Values that can no longer be the min or max before they leave the window get dropped
+		i = self.index
+		while self.lows and not self.lows[-1][1] < x: self.lows.pop()
+		while self.highs and not self.highs[-1][1] > x: self.highs.pop()
+		self.lows.append((i, x))
+		self.highs.append((i, x))
+		for q in [self.lows, self.highs]:
+			if q[0][0] <= i-self.size: q.popleft()
+		
+		self.pos += 1
+		self.index += 1
+		if self.pos==self.size:
+			self.pos = 0
+			self.mean = self.buf.mean()
+			self.m2 = ((self.buf-self.mean)**2).sum()
+	
+	@property
+	def var(self): return self.m2/(self.count-1) if self.count > 1 else nan
+	@property
+	def std(self): return sqrt(self.var)
+	@property
+	def min(self): return self.lows[0][1] if self.lows else nan
+	@property
+	def max(self): return self.highs[0][1] if self.highs else nan
+	
+	#The values in the window, oldest first
+	@property
+	def values(self): return self.buf[:self.count] if self.count < self.size else roll(self.buf, -self.pos)
+	
+	def __len__(self): return self.count
+
+#
+# SINKS
+# Stream collected data to disk in chunks as the model runs. Set with data.setSink(); Data keeps
+# only the most recent rows in memory, so memory use stays flat however long the model runs.
+#
+
+class Sink():
+	def __init__(self, chunk=1000):
+		self.chunk = chunk		#Rows to collect before writing
+	
+	#Called when the model is set up, before any rows are written
+	def reset(self): pass
+	
+	#rows is a dict of arrays, all the same length, and start is the period index of the first row
+	def write(self, rows, start): raise NotImplementedError()
+
+#Appends to a CSV in the same format as Data.saveCSV(). Each chunk is written and closed
+#before the model carries on, so a crash loses at most the rows since the last chunk.
+class CSVSink(Sink):
+	def __init__(self, filename='data', chunk=1000):
+		super().__init__(chunk)
+		self.filename = filename
+		self.file = None
+	
+	#Pick a new file for each run
+	def reset(self): self.file = None
+	
+	def write(self, rows, start):
+		import pandas
+		if self.file is None:
+			self.file = self.filename + '.csv'
+			i=0
+			while os.path.isfile(self.file): #Avoid filename collisions
+				i += 1
+				self.file = self.filename+'-'+str(i)+'.csv'
+			header = True
+		else: header = False
+		df = pandas.DataFrame(rows, index=range(start, start+len(next(iter(rows.values())))), copy=False)
+		df.to_csv(self.file, mode='a', header=header)
+
+#Writes each chunk to a numbered .npz file in a directory, keeping the float64 columns binary.
+#NumpySink.load(path) reassembles the chunks into a dataframe.
+class NumpySink(Sink):
+	def __init__(self, path='data', chunk=1000):
+		super().__init__(chunk)
+		self.path = path
+		self.dir = None
+	
+	def reset(self): self.dir = None
+	
+	def write(self, rows, start):
+		if self.dir is None:
+			self.dir = self.path
+			i=0
+			while os.path.exists(self.dir): #Avoid collisions with previous runs
+				i += 1
+				self.dir = self.path+'-'+str(i)
+			os.makedirs(self.dir)
+		
+		#Write to a temporary name and move it into place, so a partial chunk never shows up
+		file = os.path.join(self.dir, '{:010d}'.format(start))
+		with open(file+'.tmp', 'wb') as f: savez(f, **rows)
+		os.replace(file+'.tmp', file+'.npz')
+	
+	@staticmethod
+	def load(path):
+		import pandas
+		frames = []
+		for file in sorted(f for f in os.listdir(path) if f.endswith('.npz')):
+			start = int(file[:-4])
+			with load(os.path.join(path, file), allow_pickle=True) as chunk:
+				cols = {k: chunk[k] for k in chunk.files}
+			frames.append(pandas.DataFrame(cols, index=range(start, start+len(next(iter(cols.values()))))))
+		return pandas.concat(frames)
+
 class Data():
 	def __init__(self, model):
 		self.all = {}			#Data
 		self.reporters = {}
+		self.stops = []			#Stop conditions, as (description, function) tuples
+		self.stopped = None		#Description of the stop condition that has been met, if any
+		self.sink = None
+		self.keep = None		#Rows to keep in memory once written to the sink
+		self.written = 0		#Rows written to the sink so far
+		self.windows = {}		#(key, n) → (Rolling object, function or None)
+		self.schedules = {}		#Reporters not evaluated every period, key → {'every': k, 'onchange': bool or 'params'}
+		self.timestamps = {}	#Periods in which scheduled reporters recorded a new value
+		self.lastValues = {}	#The last values of scheduled reporters and their percentile series, to repeat between evaluations
+		self.paramsSet = False	#Whether a parameter has been set since the last collection
+		self.sampler = None		#Random generator for agentReporter(sample=n), separate from the model's so sampling doesn't change the run
+		self.memo = None		#Values shared between reporters within one collect(), e.g. by agentReporter() and model.agent()
 		self.model = model
 	
 	def __getitem__(self, index): return self.all[index]
-	def __setitem__(self, index, value): self.all[index] = value
+	def __setitem__(self, index, value): self.all[index] = value if isinstance(value, Column) else Column(value)
 
 	#First arg is the name of the reporter
 	#Second arg can be either a function that takes one argument – the model –
 	#or a string, either 'model' or the name of a primitive.
 	#Subsequent args get passed to the reporter functions below
+	#Pass every=k to evaluate the reporter only every k periods, and onchange=True to record a timestamp only
+	#when its value changes. onchange='params' is for reporters that depend only on parameter values, and
+	#skips evaluating them in periods where no parameter has been set. In periods where a reporter isn't
+	#evaluated, its last value is repeated so all the series line up; see data.timestamps and data.sparse().
 	def addReporter(self, key, func, **kwargs):
 		
 		#Create column space for percentile marks
@@ -43,22 +249,140 @@ class Data():
 		if not callable(mainfunc): raise TypeError('Second argument of addReporter must be callable')
 		self.reporters[key] = func
 		self[key] = []
+		
+		if kwargs.get('every', 1) > 1 or kwargs.get('onchange'):
+			self.schedules[key] = {'every': kwargs.get('every', 1), 'onchange': kwargs.get('onchange', False)}
+			self.timestamps[key] = Column()
+	
+	#Whether a scheduled reporter should be evaluated this period
+	def due(self, key, model):
+		if key not in self.lastValues: return True
+		if model.t % self.schedules[key]['every']: return False
+		return self.schedules[key]['onchange'] != 'params' or self.paramsSet
+	
+	#Registered as a parameter observer so onchange='params' reporters know when to look again
+	def paramSet(self, *args): self.paramsSet = True
 
 	def collect(self, model):
-		for var, reporter in self.reporters.items():
-			if isinstance(reporter, tuple):
-				reporter, subplots = reporter
+		prof = model.profiler
+		self.memo = {}
+		try:
+			for var, reporter in self.reporters.items():
+				if prof: start = perf_counter()
+				subplots = {}
+				if isinstance(reporter, tuple): reporter, subplots = reporter
+				last = None
+				
+				if var in self.schedules:
+					if not self.due(var, model):
+						for k, v in self.lastValues[var].items(): self[k].append(v)
+						if prof: prof.add('reporter', var, perf_counter()-start)
+						continue
+					value = reporter(model)
+					last = self.lastValues.get(var)
+					if last is None or not self.schedules[var]['onchange'] or value != last[var]: self.timestamps[var].append(model.t)
+					last = self.lastValues[var] = {var: value}
+					self[var].append(value)
+				else: self[var].append(reporter(model))
+				
 				for p, s in subplots.items():
-					self[var+'-'+str(p)+'-pctile'].append(s(model))
-			self[var].append(reporter(model))
-		model.doHooks('dataCollect', [self, model.t])
+					k, v = var+'-'+str(p)+'-pctile', s(model)
+					self[k].append(v)
+					if last is not None: last[k] = v
+				if prof: prof.add('reporter', var, perf_counter()-start)
+			model.doHooks('dataCollect', [self, model.t])
+			for (key, n), (w, func) in self.windows.items():
+				w.append(func(model) if func is not None else self[key][-1])
+			if self.sink is not None and self.rows - self.written >= self.sink.chunk: self.flush()
+			self.paramsSet = False
+			
+			for desc, cond in self.stops:
+				if cond(model):
+					self.stopped = desc
+					break
+		finally: self.memo = None
 	
 	def reset(self):
-		self.all = {k: [] for k in self.all.keys()}
+		self.all = {k: Column() for k in self.all.keys()}
+		self.stopped = None
+		self.written = 0
+		self.timestamps = {k: Column() for k in self.timestamps.keys()}
+		self.lastValues = {}
+		
+		#Derived from the model's seed without spawning from it, so each run with the same seed samples the same agents
+		seed = self.model.seedSequence
+		self.sampler = random.default_rng(random.SeedSequence(seed.entropy, spawn_key=seed.spawn_key+(0xDA7A,)))
+		if self.sink is not None: self.sink.reset()
+		for w, func in self.windows.values(): w.clear()
+	
+	#Preallocate room for a run of known length, e.g. from a stop period. Skipped if a stop condition could end the
+	#run early, and capped so that a generous period limit doesn't allocate it all up front; doubling covers the rest.
+	def reserve(self, periods):
+		if self.stops: return
+		periods = min([periods, self.rows + 2**16])
+		if self.sink is not None: periods = min([periods, self.keep+self.sink.chunk])
+		for c in self.all.values(): c.reserve(periods)
+	
+	#Returns a Rolling window over the last n values of a reporter, which keeps its mean, var, std, min, max,
+	#and ema up to date as data are collected, e.g. data.rolling('demand-jam', 50).mean. Calling again with the
+	#same key and n returns the same window. To track a quantity that isn't a reporter, pass a function of the
+	#model as func, and any name as key; windows registered before setup() are kept across runs.
+	def rolling(self, key, n, func=None, alpha=None):
+		if (key, n) not in self.windows:
+			w = Rolling(n, alpha)
+			self.windows[(key, n)] = (w, func)
+			if func is None and key in self.all:
+				for v in self[key][-n:]: w.append(v)
+		return self.windows[(key, n)][0]
+	
+	#Restore windows after loading a checkpoint, from saved Rolling objects where there are any,
+	#and otherwise by refilling them from the data
+	def refill(self, saved={}):
+		for (key, n), (w, func) in self.windows.items():
+			if (key, n) in saved: self.windows[(key, n)] = (saved[(key, n)], func)
+			else:
+				w.clear()
+				if func is None and key in self.all:
+					for v in self[key][-n:]: w.append(v)
+	
+	#Stream data to a Sink object as it's collected. keep is the number of recent rows to hold in memory
+	#for getLast() and the graphs, and should be at least as long as the graph refresh interval.
+	#Pass None to go back to keeping everything in memory.
+	def setSink(self, sink, keep=1000):
+		if sink is not None and keep < 1: raise ValueError('keep must be at least 1, since smoothing and getLast() need the last row')
+		if self.sink is not None: self.flush()
+		self.sink, self.keep = sink, keep
+		self.written = self.rows
+		if sink is not None: sink.reset()
+	
+	#Write any rows collected since the last chunk to the sink, then drop all but the last `keep` from memory
+	def flush(self):
+		if self.sink is None: return
+		rows, start = self.rows, max([self.written]+[c.start for c in self.all.values()])
+		if rows > start: self.sink.write({k: c.values[start-c.start:] for k,c in self.all.items()}, start)
+		self.written = rows
+		for c in self.all.values(): c.drop(len(c)-self.keep)
 	
+	#Total number of rows collected, including any dropped from memory
+	@property
+	def rows(self):
+		for c in self.all.values(): return c.start + len(c)
+		return 0
+	
+	#The values a scheduled reporter actually recorded, indexed by period, without the repeats in between.
+	#With a sink, only has the periods still in memory.
+	def sparse(self, key):
+		import pandas
+		col, t = self[key], self.timestamps[key].values
+		t = t[t > col.start].astype(int)
+		return pandas.Series(col.values[t-1-col.start], index=t, name=key)
+	
+	#Built on views of the columns, so this doesn't copy the data. With a sink, only has the rows still in memory.
 	@property
 	def dataframe(self):
-		return pandas.DataFrame(self.all)
+		import pandas
+		start = max([0]+[c.start for c in self.all.values()])
+		return pandas.DataFrame({k: c.values for k,c in self.all.items()}, index=range(start, self.rows), copy=False)
 	
 	#
 	# REPORTERS
@@ -71,49 +395,102 @@ class Data():
 	
 	# NOTE: Batching data collection (looping over agents and then variables, instead of – as now – looping over
 	# variables and then agents) did not result in any speed gains; in fact a marginal (0.65%) speed reduction
+	#Percentile series (percentiles=[25,75]) are all computed from the same pass over the agents as the main
+	#statistic, with a single partial sort. For very large populations, pass sample=n to compute the percentiles
+	#from a random sample of n agents instead, which is approximate but doesn't depend on the population size.
+	#Reporters gathering the same attribute within one collect() share the pass. Calls outside collect(), e.g.
+	#from step hooks or shocks, always scan the agents, since their values may have changed since the last one.
 	def agentReporter(self, key, prim='agent', breed=None, good=None, stat='mean', **kwargs):
-		if 'percentiles' in kwargs:
-			subplots = {p:self.agentReporter(key, prim, breed=breed, good=good, stat='percentile-'+str(p)) for p in kwargs['percentiles']}
-		else: subplots = None
+		def gather(model):
+			#Reporters asking for the same values in the same collection share one pass over the agents
+			memo, spec = model.data.memo, (key, prim, breed, good)
+			if memo is not None and spec in memo: return memo[spec]
+			
+			#Read straight from the ledger if the column is there
+			ledgers = [model.ledgers.get(p) for p in (model.primitives if prim=='all' else [prim])]
+			if all([l is not None and l.has(key, good) for l in ledgers]):
+				u = concatenate([l.column(key, good, breed) for l in ledgers])
+			else:
+				u = []
+				array = model.allagents.values() if prim=='all' else model.agents[prim]
+				for agent in array:
+					if breed is not None and agent.breed != breed: continue
+					v = getattr(agent, key)
+					if good is not None: v = v[good] #Narrow to goods. Hackish…
+					if v is not None: u.append(v)
+			
+			if memo is not None: memo[spec] = u
+			return u
+		
+		#Filled in by the main reporter each period, and read by the percentile series after it
+		marks = {}
+		pctiles = kwargs.get('percentiles', [])
 		
 		def reporter(model):
-			u = []
-			array = model.allagents.values() if prim=='all' else model.agents[prim]
+			u = gather(model)
+			if pctiles:
+				sample = u if 'sample' not in kwargs or len(u) <= kwargs['sample'] else model.data.sampler.choice(u, kwargs['sample'], replace=False)
+				marks.update(percentiles(sample, pctiles))
 			
-			for agent in array:
-				if breed is not None and agent.breed != breed: continue
-				v = getattr(agent, key)
-				if good is not None: v = v[good] #Narrow to goods. Hackish…
-				if v is not None: u.append(v)
-			if not u: return 0
+			if len(u)==0: return 0
 			elif stat=='sum':	return sum(u)
 			elif stat=='mean':	return mean(u)
 			elif stat=='gmean':	return exp(log(u).sum()/len(u))
 			elif stat=='std':	return std(u)
 			elif 'percentile-' in stat:
 				pctile = int(stat.split('-')[1])
-				if pctile==100: return max(u)
-				elif pctile==0: return min(u)
-				else:
-					u.sort()
-					idx = round(len(u)*pctile/100)
-					return u[idx] if len(u)>=idx+1 else u[0]
+				return percentiles(u, [pctile])[pctile]
 			else: raise ValueError('Invalid statistic '+stat)
-		return (reporter, subplots) if subplots is not None else reporter
+		
+		if not pctiles: return reporter
+		def mark(p): return lambda model: marks[p]
+		return (reporter, {p: mark(p) for p in pctiles})
+	
+	#
+	# STOP CONDITIONS
+	# Checked after the data are collected each period. Once one is met, model.run() returns,
+	# and the control panel stops the model as if it had reached the stop period.
+	#
+	
+	#Stop when func(model) returns True
+	def stopWhen(self, func, desc='Stop condition met'):
+		self.stops.append((desc, func))
+	
+	#Stop when the last `window` values of a reporter are all within atol + rtol*|mean| of each other
+	#Reads from a rolling window rather than the data, so it works however few rows a sink keeps in memory
+	def stopOnConvergence(self, key, window=10, atol=0, rtol=0):
+		self.rolling(key, window)
+		def converged(model):
+			w = self.rolling(key, window) #Looked up each time, since restoring a checkpoint replaces it
+			if len(w) < window: return False
+			return w.max - w.min <= atol + rtol*abs(w.mean)
+		self.stopWhen(converged, '\''+key+'\' converged')
+	
+	def stopAfter(self, periods):
+		self.stopWhen(lambda model: model.t >= periods, 'Reached period '+str(periods))
+	
+	#Stop if any of the reporters in keys – or any reporter at all if keys is None – comes up NaN
+	def stopOnNaN(self, keys=None):
+		def nan(model):
+			for k in (self.all.keys() if keys is None else keys):
+				v = self[k][-1] if self[k] else None
+				if isinstance(v, float) and v != v: return True
+			return False
+		self.stopWhen(nan, 'Reporter returned NaN')
 	
 	#
 	# OTHER FUNCTIONS
 	#
 	
 	#Slices the last n records for the key registered as a reporter
-	#Returns a value if n=1, otherwise a list
+	#Returns a value if n=1, otherwise an array view
 	def getLast(self, key, n=1):
 		if isinstance(key, str):
 			if len(self[key])==0: return 0
 			data = self[key][-n:]
 			return data if n>1 else data[0]
 		elif isinstance(key, int):
-			return {k: v[-key:] for k,v in self.all.items()}
+			return {k: v.values[-key:] for k,v in self.all.items()}
 		else: raise TypeError('First argument of getLast must be either a key name or an int')
 	
 	def saveCSV(self, filename='data'):
@@ -122,4 +499,14 @@ class Data():
 		while os.path.isfile(file): #Avoid filename collisions
 			i += 1
 			file = filename+'-'+str(i)+'.csv'
-		self.dataframe.to_csv(file)
\ No newline at end of file
+		self.dataframe.to_csv(file)
+
+#The values at each of a list of percentiles of u, as a dict, using one partial sort for all of them.
+#The 0th and 100th percentiles are the min and max.
+def percentiles(u, pctiles):
+	if len(u)==0: return {p: 0 for p in pctiles}
+	u = asarray(u)
+	idx = {p: int(round(len(u)*p/100)) for p in pctiles}
+	idx = {p: i if i < len(u) else len(u)-1 for p,i in idx.items()}
+	part = partition(u, list(set(idx.values())))
+	return {p: part[i] for p,i in idx.items()}
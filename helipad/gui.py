@@ -9,7 +9,7 @@ from colour import Color
 from itertools import combinations
 from numpy import ndarray, asanyarray, log10
 from math import ceil
-# import time #For performance testing
+from time import perf_counter
 import importlib, string, random as rand2
 import matplotlib.pyplot as plt
 import matplotlib.style as mlpstyle
@@ -32,7 +32,9 @@ class GUI():
 		self.balloon = Pmw.Balloon(parent) if hasPmw else None
 		self.updateEvery = 20
 		self.checks = {} #Shock checkboxes
+		self.vars = {} #Tkinter variables for menus and checkboxes, kept in sync with the model's parameters
 		self.headless = headless
+		model.paramObservers.append(self.paramChanged)
 		
 		bgcolors = ('#FFFFFF','#EEEEEE')
 		fnum = 1
@@ -40,17 +42,20 @@ class GUI():
 		#
 		# CALLBACK FUNCTION GENERATORS FOR TKINTER ELEMENTS
 		#
-		def menuCallback(fullvar, callback=None):
-			def cb(val=None):
+		#OptionMenu passes the full text of the option, so flip the options dict to get the key
+		def menuCallback(fullvar, opts, callback=None):
+			flip = {y:x for x,y in opts.items()}
+			def cb(val):
+				val = flip[val]
 				if '-' in fullvar:
 					obj, var, item = fullvar.split('-')	#Per-object variables
 					if '_' in obj:
 						obj, prim = obj.split('_')
-						val = getattr(self.model, obj+'Param')(var, item, prim=prim)
-					else: val = getattr(self.model, obj+'Param')(var, item)
+						getattr(self.model, obj+'Param')(var, item, val, prim=prim)
+					else: getattr(self.model, obj+'Param')(var, item, val)
 				else:
 					var = fullvar
-					val = self.model.param(var)
+					self.model.param(var, val)
 				
 				if callable(callback): callback(self.model, var, val)
 			return cb
@@ -72,6 +77,10 @@ class GUI():
 		def shockCallback(name):
 			return lambda: self.model.shocks.do(name)
 		
+		def shockActivate(shock, var):
+			def cb(): shock['active'] = var.get()
+			return cb
+		
 		#Toggle the progress bar between determinate and indeterminate when stopafter gets changed
 		def switchPbar(val):
 			if not val:
@@ -106,6 +115,10 @@ class GUI():
 		self.runButton = Button(frame1, text='Run', command=self.preparePlots, padx=10, pady=10, highlightbackground=bgcolors[fnum%2])
 		self.runButton.grid(row=2, column=2, pady=(15,0))
 		
+		if self.model.profiler is not None:
+			self.profileLabel = Label(frame1, text='', bg=bgcolors[fnum%2], justify=LEFT)
+			self.profileLabel.grid(row=3, column=0, columnspan=3, pady=(10,0))
+		
 		#Buttons
 		b=0
 		for f in self.model.buttons:
@@ -147,7 +160,8 @@ class GUI():
 						Label(lframe, text=name.title(), fg="#333", bg=bgcolors[fnum%2]).grid(row=0, column=1, pady=(0,8))
 				
 						if var[1]['type'] == 'menu':
-							self.sliders[bname] = OptionMenu(bpf, paramDict[k][0][name], command=menuCallback(bname, var[1]['callback']), *var[1]['opts'].values())
+							self.vars[bname] = StringVar(value=var[1]['opts'][setget(k, name, prim=prim)])
+							self.sliders[bname] = OptionMenu(bpf, self.vars[bname], command=menuCallback(bname, var[1]['opts'], var[1]['callback']), *var[1]['opts'].values())
 							self.sliders[bname].config(bg=bgcolors[fnum%2])
 						elif var[1]['type'] == 'slider':
 							self.sliders[bname] = Scale(bpf, from_=var[1]['opts']['low'], to=var[1]['opts']['high'], resolution=var[1]['opts']['step'], orient=HORIZONTAL, length=150, highlightthickness=0, command=setVar(bname), bg=bgcolors[fnum%2])
@@ -157,8 +171,9 @@ class GUI():
 					
 					#Do everything differently if we've got a checkbox
 					else:
-						self.sliders[bname] = Checkbutton(lframe, text=name.title(), var=paramDict[k][0][name], onvalue=True, offvalue=False, command=setVar(bname), bg=bgcolors[fnum%2])
-						self.sliders[bname].variable = paramDict[k][0][name] #Keep track of this because it doesn't pass the value to the callback
+						self.vars[bname] = BooleanVar(value=setget(k, name, prim=prim))
+						self.sliders[bname] = Checkbutton(lframe, text=name.title(), var=self.vars[bname], onvalue=True, offvalue=False, command=setVar(bname), bg=bgcolors[fnum%2])
+						self.sliders[bname].variable = self.vars[bname] #Keep track of this because it doesn't pass the value to the callback
 						self.sliders[bname].grid(row=0, column=1)
 					
 					bpf.columnconfigure(0,weight=1)
@@ -182,15 +197,17 @@ class GUI():
 			if var['type'] == 'hidden': continue
 			elif var['type'] == 'check':
 				f = Frame(self.parent, bg=bgcolors[fnum%2], pady=5)
-				self.sliders[k] = Checkbutton(f, text=var['title'], var=self.model.params[k][0], onvalue=True, offvalue=False, command=setVar(k), bg=bgcolors[fnum%2])
-				self.sliders[k].variable = self.model.params[k][0] #Keep track of this because it doesn't pass the value to the callback
+				self.vars[k] = BooleanVar(value=self.model.param(k))
+				self.sliders[k] = Checkbutton(f, text=var['title'], var=self.vars[k], onvalue=True, offvalue=False, command=setVar(k), bg=bgcolors[fnum%2])
+				self.sliders[k].variable = self.vars[k] #Keep track of this because it doesn't pass the value to the callback
 				self.sliders[k].pack()
 			else:
 				f = Frame(self.parent, bg=bgcolors[fnum%2], padx=10, pady=8)
 				Label(f, text=var['title'], fg="#333", bg=bgcolors[fnum%2]).pack(side=LEFT, padx=8, pady=3)
 				if var['type'] == 'menu':
 					#Callback is different because menus automatically update their variable
-					self.sliders[k] = OptionMenu(f, self.model.params[k][0], *var['opts'].values(), command=menuCallback(k, var['callback']))
+					self.vars[k] = StringVar(value=var['opts'][self.model.param(k)])
+					self.sliders[k] = OptionMenu(f, self.vars[k], *var['opts'].values(), command=menuCallback(k, var['opts'], var['callback']))
 					self.sliders[k].config(bg=bgcolors[fnum%2])
 				elif var['type'] == 'slider':
 					self.sliders[k] = Scale(f, from_=var['opts']['low'], to=var['opts']['high'], resolution=var['opts']['step'], orient=HORIZONTAL, length=150, highlightthickness=0, command=setVar(k), bg=bgcolors[fnum%2])
@@ -221,7 +238,9 @@ class GUI():
 			frame8 = expandableFrame(self.parent, text='Shocks', padx=5, pady=8, font=font, bg=bgcolors[fnum%2])
 			for shock in self.model.shocks.shocks.values():
 				if callable(shock['timerFunc']):
-					shock['guiElement'] = Checkbutton(frame8.subframe, text=shock['name'], var=shock['active'], onvalue=True, offvalue=False, bg=bgcolors[fnum%2], anchor=W)
+					active = BooleanVar(value=shock['active'])
+					shock['guiElement'] = Checkbutton(frame8.subframe, text=shock['name'], var=active, onvalue=True, offvalue=False, command=shockActivate(shock, active), bg=bgcolors[fnum%2], anchor=W)
+					shock['guiElement'].variable = active
 				elif shock['timerFunc'] == 'button':
 					shock['guiElement'] = Button(frame8.subframe, text=shock['name'], command=shockCallback(shock['name']), padx=10, pady=10)
 				
@@ -244,9 +263,19 @@ class GUI():
 		#Passes itself to the callback
 		self.model.doHooks('GUIPostInit', [self])
 	
+	#Keep menus and checkboxes in sync when parameters are changed by the model, e.g. by shocks
+	def paramChanged(self, name, val, paramType=None, obj=None, prim=None):
+		if paramType is None: key, params = (name, self.model.params)
+		elif paramType=='good': key, params = ('good-'+name+'-'+obj, self.model.goodParams)
+		else: key, params = ('breed_'+prim+'-'+name+'-'+obj, self.model.primitives[prim]['breedParams'])
+		
+		if key in self.vars:
+			self.vars[key].set(params[name][1]['opts'][val] if params[name][1]['type']=='menu' else val)
+	
 	#Start a new model
 	def preparePlots(self):
 		self.model.setup()
+		if self.stopafter.get(): self.model.data.reserve(self.stopafter.get())
 		
 		#Trim the plot list to the checked items and sent it to Graph
 		if self.headless: plotsToDraw = {k: self.model.plots[k] for k in self.model.defaultPlots}
@@ -307,10 +336,11 @@ class GUI():
 		else:
 			self.progress.config(mode='determinate')
 		
-		# start = time.time()
+		prof = self.model.profiler
 		while self.running:
 			for t in range(self.updateEvery):
 				self.model.step()
+				if self.model.data.stopped: break
 	
 			#Update graphs
 			if self.graph is not None:
@@ -318,20 +348,25 @@ class GUI():
 		
 				if (self.graph.resolution > 1):
 					data = {k: keepEvery(v, self.graph.resolution) for k,v in data.items()}
+				if prof: start = perf_counter()
 				self.graph.update(data)
+				if prof: prof.add('gui', 'graph update', perf_counter()-start)
 				self.lastUpdate = self.model.t
 				if self.graph.resolution > self.updateEvery: self.updateEvery = self.graph.resolution
 			
-			## Performance indicator
-			# newtime = time.time()
-			# print('Period', self.model.t, 'at', self.updateEvery/(newtime-start), 'periods/second')
-			# start = newtime
+			#Performance indicator
+			if prof and hasattr(self, 'profileLabel'):
+				slowest = prof.table[1] if len(prof.table) > 1 else None	#The first is the whole period
+				self.profileLabel['text'] = '{:.1f} periods/second'.format(prof.rate) + ('\nSlowest: '+slowest[1] if slowest else '')
 		
 			st = self.stopafter.get()
 			if st:
 				self.progress['value'] = self.model.t/st*100
 				if self.graph is None: self.model.root.update() #Make sure we don't hang the interface if plotless
 				if self.model.t>=st: self.terminate()
+			if self.model.data.stopped and self.running:
+				print(self.model.data.stopped+' at period '+str(self.model.t)+'.')
+				self.terminate()
 		
 		remainder = self.model.t % self.updateEvery
 		if remainder > 0: self.graph.update(self.model.data.getLast(remainder)) #Last update at the end
@@ -351,7 +386,9 @@ class GUI():
 		self.model.doHooks('pause', [self])
 	
 	def terminate(self, evt=False):
-		if self.running and (self.headless or self.expCSV.get()):
+		#With a sink, the data are already on disk and only the most recent rows are in memory
+		if self.model.data.sink is not None: self.model.data.flush()
+		elif self.running and (self.headless or self.expCSV.get()):
 			self.model.data.saveCSV(self.expCSV.get() if not self.headless else 'data')
 		
 		self.running = False
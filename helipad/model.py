@@ -6,31 +6,27 @@
 #TODO: Use multiprocessing to run the graphing in a different process
 
 #Make sure we've got the requisite modules
-import importlib, sys, warnings
-needed = ['pandas', 'matplotlib', 'colour']
+#Matplotlib and Tkinter are only needed for the GUI, so they're checked in launchGUI()
+#Pandas and Networkx are slow to import, so they're loaded only by the functions that need them
+import importlib.util, sys, warnings, threading
+needed = ['pandas', 'colour']
 for module in needed:
 	if importlib.util.find_spec(module) is None:
 		print("This model requires "+module+". Please use Pip to install it before continuing.")
 		sys.exit()
 
-if importlib.util.find_spec('networkx') is not None:
-	import networkx as nx
-	hasNx = True
-
-from random import shuffle
-from tkinter import *
-import pandas
+from random import Random
+from types import MappingProxyType
+from itertools import product
+from contextlib import nullcontext
+from bisect import bisect_left
+import heapq
 from colour import Color
-from numpy import random
-# import multiprocessing
-
-#Has to be here so we can invoke TkAgg before Tkinter initializes
-#Necessary so Matplotlib doesn't crash Tkinter, even though they don't interact
-import matplotlib
-matplotlib.use('TkAgg')
+from numpy.random import default_rng, SeedSequence
 
-from helipad.gui import GUI
 from helipad.data import Data
+from helipad.profiler import Profiler
+from time import perf_counter
 import helipad.agent as agent
 
 #Generic extensible item class to store structured data
@@ -39,27 +35,45 @@ class Item():
 		for k,v in kwargs.items():
 			setattr(self, k, v)
 
+#A read-only set of parameter values. See Helipad.takeSnapshot()
+class Snapshot(Item):
+	def __init__(self, **kwargs): self.__dict__.update(kwargs)
+	def __setattr__(self, k, v): raise AttributeError('Parameter snapshots are read-only. Use model.param() to change parameters.')
+
 class Helipad():
 	def __init__(self):
-		# Got to initialize Tkinter first in order for StringVar() and such to work
-		self.root = Tk()
-		self.root.title('Control Panel')
-		self.root.resizable(0,0)
 		self.data = Data(self)
 		self.shocks = Shocks(self)	
 			
 		self.agents = {}
+		self.agentIndex = {}	#All living agents by ID
+		self.lastID = 0
+		self.deaths = {}		#Agents awaiting removal from self.agents, by primitive. See Helipad.compact()
+		self.stepping = False
+		self.useLedger = False	#Keep agents' goods in arrays rather than dicts. See agent.Ledger and Helipad.trackAttribute()
+		self.ledgers = {}
+		self.profiler = None	#See Helipad.profile()
+		self.parallel = 0		#Step agents in this many threads. See Helipad.stepParallel()
+		self.threadState = threading.local()
+		self.partitions = {}	#Agent ID → block while stepping in parallel
+		self.lockTransactions = False	#See Helipad.transaction()
+		self.transactLock = threading.RLock()
 		self.primitives = {}
 		self.params = {}		#Global parameters
+		self.paramObservers = [self.data.paramSet]	#Functions to call when a parameter is set, e.g. to update the GUI
 		self.goods = {}			#List of goods
 		self.goodParams = {}	#Per-good parameters
 		self.hooks = {}			#External functions to run
+		self.dispatch = HookTable(self)	#Compiled hooks for each primitive
+		self.compiledHooks = {}
 		self.buttons = []
 		self.stages = 1
 		self.order = 'linear'
 		self.hasModel = False	#Have we initialized?
 		self.moneyGood = None
 		self.allEdges = {}
+		self.checkUpdates = False	#Opt in to check PyPI for a newer version when launching the GUI
+		self.seed()
 		
 		#Default parameters
 		self.addPrimitive('agent', agent.Agent, dflt=50, low=1, high=100)
@@ -75,32 +89,6 @@ class Helipad():
 		}
 		for name, label in plotList.items(): self.addPlot(name, label, selected=False)
 		self.defaultPlots = []
-		
-		#Check for updates
-		from helipad.__init__ import __version__
-		import xmlrpc.client, ssl
-		
-		#Is v1 bigger than v2?
-		#There's a `packaging` function to do this, but let's not bloat our dependencies.
-		def vcompare(v1, v2):
-			(v1, v2) = (v1.split('.'), (v2.split('.')))
-			
-			#Pad major releases with zeroes to make comparable
-			maxl = max([len(v1), len(v2)])
-			for v in [v1,v2]:
-				if len(v)<maxl: v += [0 for i in range(maxl-len(v))]
-			
-			for k,i in enumerate(v1):
-				if i > v2[k]: return True
-				elif i < v2[k]: return False
-			return False
-		
-		try:
-			pypi = xmlrpc.client.ServerProxy('https://pypi.org/pypi', context=ssl._create_unverified_context())
-			available = pypi.package_releases('helipad')
-			if vcompare(available[0], __version__):
-				print('A Helipad update is available! Use `pip install -U helipad` to upgrade to version',available[0])
-		except: pass #Fail silently if we're not online
 	
 	def addPrimitive(self, name, class_, plural=None, dflt=50, low=1, high=100, step=1, hidden=False, priority=100):
 		if name=='all': raise ValueError(name+' is a reserved name. Please choose another.')
@@ -111,7 +99,8 @@ class Helipad():
 			'plural': plural,
 			'priority': priority,
 			'breeds': {},
-			'breedParams': {}
+			'breedParams': {},
+			'tracked': []
 		}
 		self.addParameter('agents_'+name, 'Number of '+plural.title(), 'hidden' if hidden else 'slider', dflt=dflt, opts={'low': low, 'high': high, 'step': step}, callback=self.nUpdater)
 		self.agents[name] = []
@@ -192,15 +181,15 @@ class Helipad():
 		for item, i in self.goods.items():				#Cycle through goods
 			for n,p in self.goodParams.items():			#Cycle through parameters
 				if p[1]['type'] == 'hidden': continue	#Skip hidden parameters
-				self.data.addReporter(n+'-'+item, pReporter(n, paramType='good', obj=item))
+				self.data.addReporter(n+'-'+item, pReporter(n, paramType='good', obj=item), onchange='params')
 		for prim, pdata in self.primitives.items():			#Cycle through primitives
 			for breed, i in pdata['breeds'].items():		#Cycle through breeds
 				for n,p in pdata['breedParams'].items():	#Cycle through parameters
 					if p[1]['type'] == 'hidden': continue	#Skip hidden parameters
-					self.data.addReporter(prim+'_'+n+'-'+item, pReporter(n, paramType='breed', obj=breed, prim=prim))
+					self.data.addReporter(prim+'_'+n+'-'+breed, pReporter(n, paramType='breed', obj=breed, prim=prim), onchange='params')
 		for n,p in self.params.items():							#Cycle through parameters
 			if p[1]['type'] == 'hidden': continue				#Skip hidden parameters
-			self.data.addReporter(n, pReporter(n))
+			self.data.addReporter(n, pReporter(n), onchange='params')
 
 		if (self.moneyGood is not None):
 			self.data.addReporter('M0', self.data.agentReporter('goods', 'all', good=self.moneyGood, stat='sum'))
@@ -221,11 +210,25 @@ class Helipad():
 				self.data.addReporter('price-'+good, self.data.agentReporter('price', 'store', good=good))
 				self.addSeries('prices', 'price-'+good, good.title()+' Price', g.color)
 	
+		#Blank breeds for any primitives not otherwise specified, in case we haven't gone through launchGUI()
+		for k,p in self.primitives.items():
+			if len(p['breeds'])==0: self.addBreed('', '000000', prim=k)
+		
 		self.hasModel = True #Declare before instantiating agents
+		self.takeSnapshot()
 		
 		#Initialize agents
 		self.primitives = {k:v for k, v in sorted(self.primitives.items(), key=lambda d: d[1]['priority'])} #Sort by priority
+		for prim in self.primitives: self.dispatch[prim] #Compile hooks ahead of time
 		self.agents = {k: [] for k in self.primitives.keys()} #Clear any surviving agents from last run
+		self.agentIndex = {}
+		self.lastID = 0
+		self.deaths = {}
+		self.ledgers = {}
+		for prim, p in self.primitives.items():
+			if not self.useLedger and not p['tracked'] and not self.dispatch[prim].stepVector: continue
+			self.ledgers[prim] = agent.Ledger(self.goods.keys() if self.useLedger else None, p['tracked'], p['breeds'].keys(), self.param('agents_'+prim))
+			p['class'].breed = agent.TrackedBreed()
 		for prim in self.primitives:
 			self.nUpdater(self, prim, self.param('agents_'+prim))
 		
@@ -246,57 +249,17 @@ class Helipad():
 		
 		if name in params: warnings.warn('Parameter \''+name+'\' already defined. Overriding…', None, 2)
 		
-		#Instantiate the defaults.
-		#1. Are we dealing with a per-breed or a global default?
-		#1a. If per-breed, is the default universal or breed-specific?
-		#2. Do we have a menu, a check, or a slider?
+		#Instantiate the defaults. Values are stored natively – menus store the key of the selected option –
+		#and the control panel keeps its own Tkinter variables in sync.
 		#
-		#Per-breed universal menu:		str → dict{StringVar}
-		#Per-breed universal check:		bool → dict{BooleanVar}
-		#Per-breed universal slider:	int → dict{int}
-		#Per-breed specific menu:		dict{str} → dict{StringVar}
-		#Per-breed specific check:		dict{bool} → dict{BooleanVar}
-		#Per-breed specific slider:		dict{int} → dict{int}
-		#Global menu:					str → StringVar
-		#Global check:					bool → BooleanVar
-		#Global slider:					int → int
-	
+		#Per-item universal:	val → dict{val}
+		#Per-item specific:		dict{val} → dict{val}, filling in any missing items
+		#Global:				val → val
 		if paramType is not None:
 			keys = self.primitives[prim]['breeds'] if paramType=='breed' else self.goods
-			if type == 'menu':
-				deflt = {b:StringVar() for b in keys}
-				if isinstance(dflt, dict):
-					for k in deflt: deflt[k].set(opts[dflt[k]])
-					for b in keys:
-						if not b in deflt: deflt[k].set('') #Make sure we've got all the breeds in the array
-				else:
-					for k in deflt: deflt[k].set(opts[dflt]) #Set to opts[dflt] rather than dflt because OptionMenu deals in the whole string
-			elif type == 'check':
-				deflt = {b:BooleanVar() for b in keys}
-				if isinstance(dflt, dict):
-					for k in deflt: deflt[k].set(opts[dflt[k]])
-					for b in keys:
-						if not b in deflt: deflt[k].set(False) #Make sure we've got all the breeds in the array
-				else:
-					for k in deflt: deflt[k].set(dflt)
-			else:
-				deflt = {b:dflt for b in keys}
-				#No 'else' because the dict already contains default values if it's a per-breed universal slider
-				if isinstance(dflt, dict):
-					for k in deflt: deflt[k] = dflt[k] if k in dflt else 0
-				else:
-					for b in keys:
-						if not b in deflt: deflt[k] = None  #Make sure we've got all the breeds in the array
-				
-		else:
-			if type == 'menu':
-				deflt = StringVar()
-				deflt.set(opts[dflt])
-			elif type == 'check':
-				deflt = BooleanVar()
-				deflt.set(dflt)
-			else:
-				deflt = dflt
+			if isinstance(dflt, dict): deflt = {k: dflt[k] if k in dflt else itemDefault(type, opts) for k in keys}
+			else: deflt = {k: dflt for k in keys}
+		else: deflt = dflt
 		
 		params[name] = [deflt, {
 			'title': title,
@@ -335,30 +298,27 @@ class Helipad():
 		
 		#Set
 		if val is not None:
-			if params[name][1]['type'] == 'menu':
-				if paramType is None: params[name][0].set(params[name][1]['opts'][val])
-				else: params[name][0][obj].set(params[name][1]['opts'][val])
-			elif params[name][1]['type'] == 'check':
-				if paramType is None: params[name][0].set(val)
-				else: params[name][0][obj].set(val)
-			else:	
-				if paramType is None: params[name][0] = val
-				else: params[name][0][obj] = val
+			p = params[name]
+			if p[1]['type'] == 'menu' and val not in p[1]['opts']: raise KeyError('\''+str(val)+'\' is not an option for parameter \''+name+'\'')
+			if paramType is None: p[0] = val
+			else: p[0][obj] = val
+			for f in self.paramObservers: f(name, val, paramType, obj, prim)
 		
 		#Get
 		else:
-			if params[name][1]['type'] == 'menu':
-				#Flip the k/v of the options dict and return the slug from the full text returned by the menu variable
-				flip = {y:x for x,y in params[name][1]['opts'].items()}
-				if paramType is None: return flip[params[name][0].get()]							#Global parameter
-				else:
-					if obj is None: return {o:flip[v.get()] for o,v in params[name][0].items()}		#Item parameter, item unspecified
-					else: return flip[params[name][0][obj].get()]									#Item parameter, item specified
-				return flip[fullText]
-			elif params[name][1]['type'] == 'check':
-				return params[name][0].get() if paramType is None or obj is None else params[name][0][obj].get()
-			else:
-				return params[name][0] if paramType is None or obj is None else params[name][0][obj]
+			return params[name][0] if paramType is None or obj is None else params[name][0][obj]
+	
+	#Freeze the current parameter values into an object that can be read with attribute access,
+	#e.g. model.snapshot.pSmooth, model.snapshot.goods.prod['axe'], or model.snapshot.breeds['agent'].rbd['hobbit'].
+	#Taken at setup and again at the beginning of each period after shocks, so agents can read parameters
+	#from it in their step functions without going through param().
+	def takeSnapshot(self):
+		def freeze(params): return {k: MappingProxyType(dict(v[0])) if isinstance(v[0], dict) else v[0] for k,v in params.items()}
+		self.snapshot = Snapshot(
+			goods = Snapshot(**freeze(self.goodParams)),
+			breeds = {prim: Snapshot(**freeze(p['breedParams'])) for prim, p in self.primitives.items()},
+			**freeze(self.params)
+		)
 	
 	def breedParam(self, name, breed=None, val=None, prim=None):
 		if prim is None:
@@ -388,15 +348,11 @@ class Helipad():
 		
 		#Make sure the parameter arrays keep up with our items
 		for k,p in paramDict.items():
-			if isinstance(p[1].dflt, dict):
-				if name in p[1].dflt: paramDict[k][0][name] = p[1].dflt[name]	#Forgive out-of-order specification
-				elif p[1]['type']=='menu':
-					paramDict[k][0][name] = StringVar()
-					paramDict[k][0][name].set(p[1]['opts'][next(iter(p[1]['opts']))])	#Choose first item of the list
-				elif p[1]['type']=='check': paramDict[k][0][name] = BooleanVar()
-				else: paramDict[k][0][name] = 0									#Set to zero
+			if isinstance(p[1]['dflt'], dict):
+				if name in p[1]['dflt']: p[0][name] = p[1]['dflt'][name]	#Forgive out-of-order specification
+				else: p[0][name] = itemDefault(p[1]['type'], p[1]['opts'])
 			else:
-				paramDict[k][0][name] = paramDict[k][1].dflt
+				p[0][name] = p[1]['dflt']
 	
 	def addBreed(self, name, color, prim=None):
 		if prim is None:
@@ -404,6 +360,16 @@ class Helipad():
 			else: raise KeyError('Breed must specify which primitive it belongs to')
 		self.addItem('breed', name, color, prim=prim)
 		
+	#Store a numeric agent attribute in an array across all agents of a primitive, so agentReporter
+	#can compute statistics on it without looping over agents. Takes effect at setup.
+	def trackAttribute(self, name, prim='agent'):
+		cls = self.primitives[prim]['class']
+		existing = getattr(cls, name, None)
+		if existing is not None and not isinstance(existing, agent.TrackedAttribute):
+			raise ValueError('Cannot track \''+name+'\', which is already defined on '+cls.__name__)
+		if name not in self.primitives[prim]['tracked']: self.primitives[prim]['tracked'].append(name)
+		setattr(cls, name, agent.TrackedAttribute(name))
+	
 	def addGood(self, name, color, endowment=None, money=False):
 		if money:
 			if self.moneyGood is not None: print('Money good already specified as',self.moneyGood,'. Overriding…')
@@ -417,53 +383,325 @@ class Helipad():
 	def addHook(self, place, func):
 		if not place in self.hooks: self.hooks[place] = []
 		self.hooks[place].append(func)
+		
+		#Recompile on next use
+		self.dispatch.clear()
+		self.compiledHooks.clear()
 	
 	#Returns the value of the last function in the list
+	#Can also take a list of hooks, in which case it goes until we get a response
 	def doHooks(self, place, args):
-		#Take a list of hooks; go until we get a response
-		if isinstance(place, list):
-			for f in place:
-				r = self.doHooks(f, args)
-				if r is not None: return r
-			return None
-		
-		if not place in self.hooks: return None
-		for f in self.hooks[place]: r = f(*args)
+		key = tuple(place) if isinstance(place, list) else place
+		if not key in self.compiledHooks: self.compiledHooks[key] = self.compileHooks(place)
+		f = self.compiledHooks[key]
+		if not f: return None
+		if self.profiler is None: return f(*args)
+		
+		start = perf_counter()
+		r = f(*args)
+		self.profiler.add('hook', place if isinstance(place, str) else '/'.join(place), perf_counter()-start)
 		return r
+	
+	#Compiles a hook place, or a list of places to try in order, into a single function,
+	#so that running the hooks doesn't require looking them up each time.
+	#Returns None if there's nothing to run.
+	def compileHooks(self, places):
+		if not isinstance(places, list): places = [places]
+		funcs = [self.hooks[p] for p in places if p in self.hooks and self.hooks[p]]
+		
+		if not funcs: return None
+		elif len(funcs)==1:
+			funcs = funcs[0]
+			if len(funcs)==1: return funcs[0]
+			def dispatch(*args):
+				for f in funcs: r = f(*args)
+				return r
+		else:
+			def dispatch(*args):
+				for place in funcs:
+					for f in place: r = f(*args)
+					if r is not None: return r
+		return dispatch
 				
 	def step(self):
+		prof = self.profiler
+		if prof: begin = perf_counter()
 		self.t += 1
+		self.compact()	#Anyone who died between periods
+		self.stepping = True
 		self.doHooks('modelPreStep', [self])
 		
 		#Reset per-period variables
 		#Have to do this all at once at the beginning of the period, not when each agent steps
-		for p in self.agents.values():
-			for a in p:
-				a.currentDemand = {g:0 for g in self.goods.keys()}
-				a.currentShortage = {g:0 for g in self.goods.keys()}
+		for prim, p in self.agents.items():
+			if self.useLedger: self.ledgers[prim].reset()
+			else:
+				for a in p:
+					a.currentDemand = {g:0 for g in self.goods.keys()}
+					a.currentShortage = {g:0 for g in self.goods.keys()}
 		
+		if prof: start = perf_counter()
 		self.shocks.step()
+		if prof: prof.add('shocks', 'Shocks.step', perf_counter()-start)
+		self.takeSnapshot()
 		
 		#Shuffle or sort agents as necessary
 		for prim, lst in self.agents.items():
-			if self.order == 'random': shuffle(lst)
-			o = self.doHooks([prim+'Order', 'order'], [prim, lst, self])	#Individual and global order hooks 
-			if o is not None: self.agents[prim] = o
+			if self.order == 'random': self.random.shuffle(lst)
+			order = self.dispatch[prim].order	#Individual and global order hooks
+			if order:
+				o = order(prim, lst, self)
+				if o is not None: self.agents[prim] = o
 			
 		for self.stage in range(1, self.stages+1):
 			self.doHooks('modelStep', [self, self.stage])
-			for t in self.agents.values():
-				for a in t:
-					a.step(self.stage)
+			for prim, t in self.agents.items():
+				if prof: start = perf_counter()
+				
+				#A vectorized step hook replaces stepping each agent individually
+				stepVector = self.dispatch[prim].stepVector
+				if stepVector:
+					stepVector(agent.LedgerFrame(self.ledgers[prim]), self, self.stage)
+					if self.stage == self.stages:
+						for a in t: a.age += 1
+				elif self.parallel > 1 and len(t) > 1: self.stepParallel(t)
+				else:
+					for a in t:
+						if not a.dead: a.step(self.stage)
+				if prof: prof.add('step', prim+' stage '+str(self.stage), perf_counter()-start)
+			self.compact()
 		
 		self.data.collect(self)
 		self.doHooks('modelPostStep', [self])
+		self.stepping = False
+		if prof:
+			prof.add('model', 'period', perf_counter()-begin)
+			prof.periods += 1
+		return self.t
+	
+	#Start recording where the model spends its time. Returns the Profiler, which is also at model.profiler.
+	#Pass False to turn profiling off again.
+	def profile(self, on=True):
+		self.profiler = Profiler() if on else None
+		return self.profiler
+	
+	#Step a primitive's agents in self.parallel threads, each taking a contiguous block of the list. Each thread
+	#draws from its own random streams, spawned from the model's seed, and anything that would touch an agent in
+	#another block – trades, payments, births, deaths, or anything passed to defer() – is queued until every
+	#thread is done, and then run on the main thread in block order. Results are therefore reproducible for a
+	#given seed and number of threads, but not identical to a serial run. Deferred calls return None; see
+	#transaction() for running trades and payments right away instead. Hooks that write shared model state
+	#directly, e.g. model.land[...].input += … in Cities, are not protected and should be deferred.
+	def stepParallel(self, agents):
+		from concurrent.futures import ThreadPoolExecutor
+		n = min(self.parallel, len(agents))
+		size = -(-len(agents)//n)
+		blocks = [agents[i*size:(i+1)*size] for i in range(n)]
+		self.partitions = {a.id: i for i, block in enumerate(blocks) for a in block}
+		streams = [generators(s) for s in self.seedSequence.spawn(n)]
+		queues = [[] for i in range(n)]
+		
+		def work(i):
+			local = self.threadState
+			local.partition, local.queue = i, queues[i]
+			local.rng, local.random = streams[i]
+			for a in blocks[i]:
+				if not a.dead: a.step(self.stage)
+		
+		rng, random = self.rng, self.random
+		self.rng, self.random = ThreadLocal(self.threadState, 'rng'), ThreadLocal(self.threadState, 'random')
+		try:
+			with ThreadPoolExecutor(n) as pool: list(pool.map(work, range(n)))
+		finally:
+			self.rng, self.random = rng, random
+			self.partitions = {}
+		
+		for queue in queues:
+			for func, args in queue: func(*args)
+	
+	#Whether the current thread is stepping agents in parallel and any of the agents belong to another thread.
+	#With no agents, whether the current thread is stepping agents in parallel at all.
+	def foreign(self, *agents):
+		p = getattr(self.threadState, 'partition', None)
+		if p is None: return False
+		return not agents or any(self.partitions.get(a.id) != p for a in agents)
+	
+	#Whether a trade or payment between these agents has to wait until the end of the parallel stage
+	def deferring(self, *agents): return not self.lockTransactions and self.foreign(*agents)
+	
+	#With model.lockTransactions = True, trades and payments between agents in different blocks run right away
+	#under a lock instead of being deferred, so they can return their results. They then happen in whatever order
+	#the threads reach them, so runs are no longer reproducible. Transactions within a block don't take the lock.
+	def transaction(self, *agents):
+		return self.transactLock if self.lockTransactions and self.foreign(*agents) else nullcontext()
+	
+	#Queue a function to run after a parallel stage. See stepParallel()
+	def defer(self, func, *args):
+		if not self.foreign(): return func(*args)
+		self.threadState.queue.append((func, args))
+	
+	#Defer a call whose caller may be expecting a result, and warn that it got None instead
+	def deferResult(self, func, *args):
+		warnings.warn(func.__name__+'() between agents in different blocks was deferred to the end of the stage and returned None. Set model.lockTransactions = True to run it right away instead.', None, 3)
+		return self.defer(func, *args)
+	
+	#Run the model without the GUI, for batch runs or for embedding in other code.
+	#Stops after `periods` periods, when stop(model) returns True, or when one of the stop conditions
+	#registered with the Data object is met, whichever comes first.
+	#Sets up a new model if there isn't one already; otherwise picks up where the last run left off.
+	def run(self, periods=None, stop=None):
+		if periods is None and stop is None and not self.data.stops:
+			raise ValueError('run() requires a number of periods, a stop function, or a stop condition')
+		if not self.hasModel: self.setup()
+		
+		self.data.stopped = None #Each run goes until its own stop, e.g. for a fork after a warm-up that ended on one
+		end = None if periods is None else self.t + periods
+		if end is not None and stop is None: self.data.reserve(end)
+		while end is None or self.t < end:
+			self.step()
+			if self.data.stopped or (callable(stop) and stop(self)): break
+		self.data.flush()
+		return self.t
+	
+	#Seed the model's random number generators. Models should draw random numbers from model.random
+	#(a Python Random object) and model.rng (a Numpy Generator) rather than the global generators,
+	#so that runs can be reproduced. Takes an int, a Numpy SeedSequence, or None for a fresh seed.
+	def seed(self, seed=None):
+		if not isinstance(seed, SeedSequence): seed = SeedSequence(seed)
+		self.seedSequence = seed
+		self.rng, self.random = generators(seed)
+	
+	#Run the model headless once for each combination of parameter values, spread across processes.
+	#params is either a dict of parameter names and lists of values, which are crossed into a grid,
+	#or a list of dicts for specific configurations. Per-item parameters take the names used by
+	#updateVar(), e.g. 'good-prod-axe' or 'breed_agent-rbd-hobbit'.
+	#Returns a list of (configuration, dataframe) tuples, in the order of the configurations.
+	def sweep(self, params, periods=None, stop=None, processes=None):
+		if isinstance(params, dict): configs = [dict(zip(params.keys(), vals)) for vals in product(*params.values())]
+		else: configs = list(params)
+		
+		def run(config):
+			self.hasModel = False #Keep callbacks from acting on a model inherited from the parent
+			for k,v in config.items(): self.updateVar(k, v)
+			self.setup()
+			self.run(periods, stop)
+			return self.data.dataframe
+		
+		return list(zip(configs, batch(run, configs, processes)))
+	
+	#Branch a running model into several scenarios, each continuing from the current state in its own forked
+	#process, so a long warm-up only has to be run once. branches is either a list of parameter overrides,
+	#named as in sweep(), or an int, for that many branches with unchanged parameters and independent random
+	#streams. Branches can also be functions, which take the model and can e.g. trigger shocks. Overridden
+	#branches share the model's random state, so differences between them are due to the overrides.
+	#Returns a list of (branch, dataframe) tuples, with the data from the warm-up included in each dataframe.
+	def fork(self, branches, periods=None, stop=None, processes=None):
+		if not self.hasModel: raise RuntimeError('There is no model to fork. Set up and run the warm-up first.')
+		if isinstance(branches, int): branches = self.seedSequence.spawn(branches)
+		else: branches = list(branches)
+		
+		def run(branch):
+			if isinstance(branch, SeedSequence): self.seed(branch)
+			elif callable(branch): branch(self)
+			else:
+				for k,v in branch.items(): self.updateVar(k, v)
+			self.run(periods, stop)
+			return self.data.dataframe
+		
+		return list(zip(branches, batch(run, branches, processes)))
+	
+	#Run n replicates of the model headless across processes, each with an independent random stream
+	#spawned from seed. Returns an Item with the dataframes from each run, along with the mean and
+	#quantile bands of each numeric reporter by period.
+	def replicate(self, n, periods=None, stop=None, seed=None, quantiles=[0.05, 0.95], processes=None):
+		seeds = SeedSequence(seed).spawn(n)
+		
+		def run(seed):
+			self.hasModel = False
+			self.seed(seed)
+			self.setup()
+			self.run(periods, stop)
+			return self.data.dataframe
+		
+		runs = batch(run, seeds, processes)
+		import pandas
+		periods = pandas.concat(runs).select_dtypes('number').groupby(level=0)
+		return Item(
+			runs=runs,
+			mean=periods.mean(),
+			quantiles={q: periods.quantile(q) for q in quantiles}
+		)
+	
+	#Save the state of a running model – agents, edges, parameter values, shock switches, random generators,
+	#collected data, and any attributes hooks have set on the model – to a binary file. Configuration
+	#(hooks, reporters, parameter definitions) is not saved; see restore(). The file is written to a
+	#temporary name and moved into place, so a crash mid-write leaves any previous checkpoint intact.
+	def checkpoint(self, path):
+		if not self.hasModel: raise RuntimeError('There is no model to checkpoint. Call setup() first.')
+		import pickle, os
+		from helipad.__init__ import __version__
+		
+		cp = {
+			'version': __version__,
+			'state': {k:v for k,v in self.__dict__.items() if k not in checkpointExclude},
+			'params': {
+				'global': {k: v[0] for k,v in self.params.items()},
+				'good': {k: v[0] for k,v in self.goodParams.items()},
+				'breed': {prim: {k: v[0] for k,v in p['breedParams'].items()} for prim, p in self.primitives.items()}
+			},
+			'shocks': {name: shock['active'] for name, shock in self.shocks.shocks.items()},
+			'data': self.data.all,
+			'windows': {k: w for k,(w,func) in self.data.windows.items()},
+			'timestamps': self.data.timestamps,
+			'lastValues': self.data.lastValues
+		}
+		
+		#Refer to the model and its components by name rather than pickling them
+		persistent = {id(self): 'model', id(self.data): 'data', id(self.shocks): 'shocks'}
+		class Pickler(pickle.Pickler):
+			def persistent_id(self, obj): return persistent.get(id(obj))
+		
+		tmp = path+'.tmp'
+		with open(tmp, 'wb') as f: Pickler(f, protocol=5).dump(cp)
+		os.replace(tmp, path)
+	
+	#Load a checkpoint into a model configured the same way as the one that saved it – normally by running the
+	#same model file, minus the launchGUI() or run() call. Sets the model up, then replaces its state.
+	def restore(self, path):
+		import pickle
+		from helipad.__init__ import __version__
+		self.setup()
+		
+		persistent = {'model': self, 'data': self.data, 'shocks': self.shocks}
+		class Unpickler(pickle.Unpickler):
+			def persistent_load(self, pid): return persistent[pid]
+		with open(path, 'rb') as f: cp = Unpickler(f).load()
+		if cp['version'] != __version__: warnings.warn('Checkpoint was saved with Helipad '+cp['version']+'.', None, 2)
+		
+		self.__dict__.update(cp['state'])
+		for k,v in cp['params']['global'].items():
+			if k in self.params: self.param(k, v)
+		for k,v in cp['params']['good'].items():
+			if k not in self.goodParams: continue
+			for good, val in v.items(): self.param(k, val, paramType='good', obj=good)
+		for prim, params in cp['params']['breed'].items():
+			for k,v in params.items():
+				if k not in self.primitives[prim]['breedParams']: continue
+				for breed, val in v.items(): self.param(k, val, paramType='breed', obj=breed, prim=prim)
+		for name, active in cp['shocks'].items():
+			if name in self.shocks.shocks: self.shocks[name]['active'] = active
+		self.data.all = cp['data']
+		self.data.timestamps.update(cp['timestamps'])
+		self.data.lastValues.update(cp['lastValues'])
+		self.data.refill(cp['windows'])
+		self.takeSnapshot()
 		return self.t
 	
 	def network(self, kind='edge', prim=None):
-		if not hasNx:
+		if importlib.util.find_spec('networkx') is None:
 			warnings.warn('Network export requires Networkx.', None, 2)
 			return
+		import networkx as nx
 		
 		G = nx.Graph()
 		agents = self.allagents.values() if prim is None else self.agents[prim]
@@ -474,7 +712,7 @@ class Helipad():
 		return G
 	
 	def showNetwork(self, kind='edge', prim=None):
-		import matplotlib.pyplot as plt
+		import matplotlib.pyplot as plt, networkx as nx
 		G = self.network(kind, prim)
 		plt.figure() #New window
 		nx.draw(G)
@@ -487,7 +725,7 @@ class Helipad():
 		
 		#Makes sure changes are reflected in the sliders
 		#Checkboxes and menus update regardless of the updateGUI setting
-		if updateGUI and var in self.gui.sliders and hasattr(self.gui.sliders[var], 'set'):
+		if updateGUI and hasattr(self, 'gui') and var in self.gui.sliders and hasattr(self.gui.sliders[var], 'set'):
 			self.gui.sliders[var].set(newval)
 		
 		if '-' in var:
@@ -515,12 +753,29 @@ class Helipad():
 			if 'callback' in self.params[var][1] and callable(self.params[var][1]['callback']):
 				self.params[var][1]['callback'](self, var, newval)
 	
+	#All living agents by ID. This is the live index rather than a copy, and die() and reproduce() modify it,
+	#so code that kills or creates agents while looping over it should loop over list(model.allagents.values())
 	@property
-	def allagents(self):
-		agents = {}
-		for k, l in self.agents.items():
-			agents.update({a.id:a for a in l})
-		return agents
+	def allagents(self): return self.agentIndex
+	
+	#Dead agents are marked and dropped from the ID index immediately, but stay in self.agents until the
+	#list is compacted, so that agents can die while the list is being iterated. This happens at the end
+	#of each stage, or immediately from killMany() outside of a step. Compaction is one linear pass
+	#per primitive, no matter how many agents died.
+	def compact(self):
+		for prim, n in self.deaths.items():
+			if not n: continue
+			self.agents[prim][:] = [a for a in self.agents[prim] if not a.dead]
+			self.deaths[prim] = 0
+	
+	def killMany(self, agents):
+		for a in agents: a.die()
+		if not self.stepping: self.compact()
+	
+	#Agent IDs are allocated monotonically, so they're never reused within a run, even after an agent dies
+	def nextID(self):
+		self.lastID += 1
+		return self.lastID
 	
 	#CALLBACK FOR DEFAULT PARAMETERS
 	#Model param redundant, strictly speaking, but it's necessary to make the signature match the other callbacks, where it is necessary
@@ -529,34 +784,27 @@ class Helipad():
 		
 		if 'agents_' in prim: prim = prim.split('_')[1] #Because updateVar will pass agents_{prim}
 		array = self.agents[prim]
-		diff = val - len(array)
+		diff = val - (len(array) - self.deaths.get(prim, 0)) #Don't count agents that have died but not been compacted
 
 		#Add agents
 		if diff > 0:
-			maxid = 1
-			for id, a in self.allagents.items():
-				if a.id > maxid: maxid = a.id #Figure out maximum existing ID
 			for i in range(0, int(diff)):
-				maxid += 1
+				id = self.nextID()
 				
-				breed = self.doHooks([prim+'DecideBreed', 'decideBreed'], [maxid, self.primitives[prim]['breeds'].keys(), self])
+				decideBreed = self.dispatch[prim].decideBreed
+				breed = decideBreed(id, self.primitives[prim]['breeds'].keys(), self) if decideBreed else None
 				if breed is None: breed = list(self.primitives[prim]['breeds'].keys())[i%len(self.primitives[prim]['breeds'])]
 				if not breed in self.primitives[prim]['breeds']:
 					raise ValueError('Breed \''+breed+'\' is not registered for the \''+prim+'\' primitive')
-				new = self.primitives[prim]['class'](breed, maxid, self)
+				new = self.primitives[prim]['class'](breed, id, self)
 				array.append(new)
+				self.agentIndex[id] = new
 		
 		#Remove agents
 		elif diff < 0:
-			shuffle(array) #Delete agents at random
-			
-			#Remove agents, maintaining the proportion between breeds
-			n = {x: 0 for x in self.primitives[prim]['breeds'].keys()}
-			for a in self.agents[prim]:
-				if n[a.breed] < -diff:
-					n[a.breed] += 1
-					a.die()
-				else: continue
+			live = [a for a in array if not a.dead] if self.deaths.get(prim) else array
+			self.killMany(self.random.sample(live, -int(diff))) #Delete agents at random, which maintains the proportion between breeds in expectation
+			self.param('agents_'+prim, val) #die() decrements the count, which has already been set
 		
 	#
 	# DEBUG FUNCTIONS
@@ -564,16 +812,21 @@ class Helipad():
 	#
 	
 	#Return agents of a breed if string; return specific agent with ID otherwise
+	#Returns a list of agents of a breed, or a single agent by ID. While data are being collected, lists of
+	#agents by breed are computed once and shared between reporters, so they shouldn't be modified.
 	def agent(self, var, primitive='agent'):
 		if isinstance(var, str):
-			return [a for a in self.agents[primitive] if a.breed==var]
+			memo, spec = self.data.memo, ('breed', var, primitive)
+			if memo is not None and spec in memo: return memo[spec]
+			agents = [a for a in self.agents[primitive] if a.breed==var and not a.dead]
+			if memo is not None: memo[spec] = agents
+			return agents
 		else:
-			return self.allagents[var]
-		
-		return None #If nobody matched
+			return self.agentIndex.get(var) #None if nobody matched
 		
 	#Returns summary statistics on an agent variable at a single point in time
 	def summary(self, var, prim='agent', breed=None):
+		import pandas
 		agents = self.agents['agent'] if breed is None else self.agent(breed, prim)
 		data = pandas.Series([getattr(a, var) for a in agents]) #Pandas gives us nice statistical functions
 		stats = {
@@ -593,6 +846,22 @@ class Helipad():
 	#
 
 	def launchGUI(self, headless=False):
+		if importlib.util.find_spec('matplotlib') is None:
+			print("The GUI requires matplotlib. Please use Pip to install it before continuing.")
+			sys.exit()
+		
+		#Has to be here so we can invoke TkAgg before Tkinter initializes
+		#Necessary so Matplotlib doesn't crash Tkinter, even though they don't interact
+		import matplotlib
+		matplotlib.use('TkAgg')
+		from tkinter import Tk
+		from helipad.gui import GUI
+		
+		# Got to initialize Tkinter first in order for StringVar() and such to work
+		self.root = Tk()
+		self.root.title('Control Panel')
+		self.root.resizable(0,0)
+		
 		#Callback takes one parameter, model object
 		self.doHooks('GUIPreLaunch', [self])
 		
@@ -630,6 +899,8 @@ class Helipad():
 				shell.interact()
 			else: print('Use pip to install readline and code for a debug console')
 		
+		if self.checkUpdates and not headless: checkForUpdates()
+		
 		if headless:
 			self.root.destroy()
 			self.gui.preparePlots()		#Jump straight to the graph
@@ -638,10 +909,46 @@ class Helipad():
 		#Callback takes one parameter, GUI object
 		self.doHooks('GUIPostLaunch', [self.gui])
 
+#Forwards to an attribute of a threading.local, so that each thread stepping agents in parallel
+#can be handed its own random generators under the same name.
+class ThreadLocal():
+	def __init__(self, local, name):
+		self.local = local
+		self.name = name
+	def __getattr__(self, k): return getattr(getattr(self.local, self.name), k)
+
+#Compiled hooks for each primitive, so agents don't have to build lists of hook names every time they step.
+#Tables are compiled on first access and cleared whenever a hook is added.
+class HookTable(dict):
+	def __init__(self, model):
+		self.model = model
+	
+	def __missing__(self, prim):
+		compile = self.model.compileHooks
+		self[prim] = Item(
+			init = compile(['baseAgentInit', prim+'Init']),
+			step = compile(['baseAgentStep', prim+'Step']),
+			stepVector = compile(['baseAgentStepVector', prim+'StepVector']),
+			reproduce = compile(['baseAgentReproduce', prim+'Reproduce']),
+			die = compile(['baseAgentDie', prim+'Die']),
+			order = compile([prim+'Order', 'order']),
+			decideBreed = compile([prim+'DecideBreed', 'decideBreed']),
+			preTrade = compile('preTrade'),
+			postTrade = compile('postTrade'),
+			buy = compile('buy'),
+			pay = compile('pay'),
+			checkBalance = compile('checkBalance')
+		)
+		return self[prim]
+
+#Shocks with deterministic timers (atperiod and everyn) are kept on a heap by the next period they fire,
+#so they cost nothing in periods where they don't. Other timer functions are polled every period.
 class Shocks():
 	def __init__(self, model):
 		self.shocks = {}
 		self.model = model
+		self.queue = None	#Heap of (period, registration order, name), built on the next step
+		self.lastT = None
 	
 	def __getitem__(self, index): return self.shocks[index]
 	def __setitem__(self, index, value): self.shocks[index] = value
@@ -662,14 +969,37 @@ class Shocks():
 			'paramType': paramType,
 			'obj': obj,
 			'prim': prim,
-			'active': BooleanVar() #Saves some Tkinter code later
+			'active': active
 		}
-		self[name]['active'].set(active)
-		
-	def step(self):
+		self.queue = None
+	
+	#Build the heap from period t, and sort out which timers have to be polled
+	def schedule(self, t):
+		self.order = {name: i for i, name in enumerate(self.shocks)}
+		self.polled = [name for name, shock in self.shocks.items() if callable(shock['timerFunc']) and not hasattr(shock['timerFunc'], 'nextFire')]
+		self.queue = []
 		for name, shock in self.shocks.items():
-			if shock['active'].get() and callable(shock['timerFunc']) and shock['timerFunc'](self.model.t):
-				self.do(name)
+			if not hasattr(shock['timerFunc'], 'nextFire'): continue
+			nxt = shock['timerFunc'].nextFire(t)
+			if nxt is not None: self.queue.append((nxt, self.order[name], name))
+		heapq.heapify(self.queue)
+	
+	def step(self):
+		t = self.model.t
+		if self.queue is None or t != self.lastT+1: self.schedule(t) #New model, or the clock has been reset
+		self.lastT = t
+		
+		due = []
+		while self.queue and self.queue[0][0] <= t:
+			_, i, name = heapq.heappop(self.queue)
+			nxt = self[name]['timerFunc'].nextFire(t+1)
+			if nxt is not None: heapq.heappush(self.queue, (nxt, i, name))
+			due.append(name)
+		
+		#Fire in the order registered, as if every timer were polled
+		for name in sorted(self.polled+due, key=self.order.get) if due else self.polled:
+			shock = self[name]
+			if shock['active'] and (name in due or shock['timerFunc'](t)): self.do(name)
 	
 	def do(self, name):
 		shock = self[name]
@@ -698,21 +1028,25 @@ class Shocks():
 	#With n% probability each period
 	def randn(self, n):
 		if n<0 or n>100: raise ValueError('randn() argument can only be between 0 and 100')
-		def fn(t): return True if random.randint(0,100) < n else False
+		def fn(t): return True if self.model.rng.integers(0,100) < n else False
 		return fn
 	
 	#Once at t=n. n can be an int or a list of periods
 	def atperiod(self, n):
-		def fn(t):
-			if type(n) == list:
-				return True if t in n else False
-			else:
-				return True if t==n else False
+		periods = sorted(set(n)) if type(n) == list else [n]
+		lookup = set(periods)
+		def fn(t): return t in lookup
+		def nextFire(t):
+			i = bisect_left(periods, t)
+			return periods[i] if i < len(periods) else None
+		fn.nextFire = nextFire
 		return fn
 	
 	#Regularly every n periods
 	def everyn(self, n, offset=0):
 		def fn(t): return True if t%n-offset==0 else False
+		def nextFire(t): return t + (offset-t)%n if 0 <= offset < n else None
+		fn.nextFire = nextFire
 		return fn
 
 #Append to the Color class
@@ -720,5 +1054,87 @@ def lighten(self):
 	return Color(hue=self.hue, saturation=self.saturation, luminance=.66+self.luminance/3)
 Color.lighten = lighten
 
+#Default value for an item in a per-item parameter where none is specified
+def itemDefault(type, opts):
+	if type=='menu': return next(iter(opts))	#Choose first item of the list
+	elif type=='check': return False
+	else: return 0
+
+#Attributes that are configuration or framework machinery rather than model state, for Helipad.checkpoint().
+#Everything else on the model object is saved, including attributes set by hooks.
+checkpointExclude = {
+	'data', 'shocks', 'primitives', 'params', 'goodParams', 'goods', 'hooks', 'dispatch', 'compiledHooks',
+	'paramObservers', 'buttons', 'plots', 'defaultPlots', 'stages', 'order', 'moneyGood', 'hasModel', 'stepping',
+	'snapshot', 'useLedger', 'parallel', 'threadState', 'partitions', 'lockTransactions', 'transactLock', 'checkUpdates',
+	'profiler', 'gui', 'root'
+}
+
+#Returns a Numpy Generator and a Python Random object seeded from a SeedSequence
+def generators(seed):
+	#Numpy's PCG64 draws the first four words of state; seed the Python generator from the next four
+	return default_rng(seed), Random(int.from_bytes(seed.generate_state(8, 'uint64')[4:].tobytes(), 'little'))
+
 def makeDivisible(n, div, c='min'):
-	return n-n%div if c=='min' else n+(div-n%div if n%div!=0 else 0)
\ No newline at end of file
+	return n-n%div if c=='min' else n+(div-n%div if n%div!=0 else 0)
+
+#Is v1 bigger than v2?
+#There's a `packaging` function to do this, but let's not bloat our dependencies.
+def vcompare(v1, v2):
+	(v1, v2) = ([int(i) if i.isdigit() else i for i in v.split('.')] for v in (v1, v2))
+	
+	#Pad major releases with zeroes to make comparable
+	maxl = max([len(v1), len(v2)])
+	for v in [v1,v2]:
+		if len(v)<maxl: v += [0 for i in range(maxl-len(v))]
+	
+	for k,i in enumerate(v1):
+		try:
+			if i > v2[k]: return True
+			elif i < v2[k]: return False
+		except TypeError: return str(i) > str(v2[k]) #Pre-release tags
+	return False
+
+#Check PyPI for a newer version in a background thread so it doesn't hold up the model,
+#and hit the network at most once a day, caching the result in the user's home directory.
+def checkForUpdates():
+	from helipad.__init__ import __version__
+	import json, os, threading, time, urllib.request
+	cache = os.path.join(os.path.expanduser('~'), '.helipad-version')
+	
+	def notify(available):
+		if vcompare(available, __version__):
+			print('A Helipad update is available! Use `pip install -U helipad` to upgrade to version',available)
+	
+	try:
+		with open(cache) as f: cached = json.load(f)
+		if time.time() - cached['time'] < 86400: return notify(cached['version'])
+	except (OSError, ValueError, KeyError): pass
+	
+	def check():
+		try:
+			with urllib.request.urlopen('https://pypi.org/pypi/helipad/json', timeout=5) as response:
+				available = json.load(response)['info']['version']
+			with open(cache, 'w') as f: json.dump({'time': time.time(), 'version': available}, f)
+			notify(available)
+		except Exception: pass #Fail silently if we're not online
+	threading.Thread(target=check, daemon=True).start()
+
+#Batch runs fork the model into worker processes rather than pickling it, since hooks are generally closures.
+#The function to run in each worker is stashed here before forking, and each worker is used for only
+#one run so that state from one configuration doesn't leak into the next.
+batchFunc = None
+def batchWorker(arg): return batchFunc(arg)
+
+def batch(func, args, processes=None):
+	global batchFunc
+	import multiprocessing
+	
+	#Import Pandas before forking, so workers don't each have to, and so the thread unpickling
+	#dataframes doesn't hold the import lock while a replacement worker is being forked.
+	import pandas
+	try: ctx = multiprocessing.get_context('fork')
+	except ValueError: raise RuntimeError('Batch runs require a platform that can fork processes.')
+	
+	batchFunc = func
+	with ctx.Pool(processes, maxtasksperchild=1) as pool:
+		return pool.map(batchWorker, args, chunksize=1)
\ No newline at end of file
@@ -0,0 +1,44 @@
+# ==========
+# Wall-clock profiling of model runs
+# Do not run this file; import model.py and run from your file.
+# ==========
+
+#Turn on with model.profile(). Records the total time and number of calls for each hook place, each primitive
+#in each stage, each reporter, shocks, and graph updates. Times are inclusive, so a hook that runs inside
+#a primitive's step is counted in both.
+class Profiler():
+	def __init__(self):
+		self.reset()
+
+	def reset(self):
+		self.times = {}		#(category, name) → [seconds, calls]
+		self.periods = 0
+
+	def add(self, category, name, elapsed):
+		key = (category, name)
+		if key in self.times:
+			self.times[key][0] += elapsed
+			self.times[key][1] += 1
+		else: self.times[key] = [elapsed, 1]
+
+	#Periods per second, not counting time spent between periods, e.g. drawing the graph
+	@property
+	def rate(self):
+		elapsed = self.times[('model', 'period')][0] if ('model', 'period') in self.times else 0
+		return self.periods/elapsed if elapsed else 0
+
+	#(category, name, seconds, calls, seconds per call) tuples, slowest first
+	@property
+	def table(self):
+		rows = [(k[0], k[1], v[0], v[1], v[0]/v[1]) for k,v in self.times.items()]
+		return sorted(rows, key=lambda r: r[2], reverse=True)
+
+	@property
+	def dataframe(self):
+		import pandas
+		return pandas.DataFrame(self.table, columns=['category', 'name', 'seconds', 'calls', 'per call'])
+
+	def report(self, n=20):
+		print('{:.1f} periods/second'.format(self.rate))
+		for category, name, secs, calls, per in self.table[:n]:
+			print('{:<10} {:<30} {:>9.3f}s {:>8} calls {:>9.1f}µs/call'.format(category, name, secs, calls, per*1e6))
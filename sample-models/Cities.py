@@ -94,7 +94,7 @@ def agentStep(agent, model, stage):
 		otherwage = log(oprod)*agent.prod[otherloc]/oprod		
 		
 		#Decide whether or not to move
-		mvc = model.param('movecost')
+		mvc = model.snapshot.movecost
 		if otherwage > agent.lastWage*1.25 and agent.wealth > mvc: #and model.t > 10000:
 		# if agent.prod[otherloc]-mvc > agent.prod[agent.breed] and agent.wealth > mvc: #and model.t > 10000:
 			# print('T=',model.t,', HC',agent.H,':',agent.breed,'wage=',agent.lastWage,',',otherloc,'wage=',otherwage)
@@ -105,10 +105,10 @@ def agentStep(agent, model, stage):
 		model.land[agent.breed].input += agent.prod[agent.breed] #Work
 		
 		#Reproduce
-		rand = random.randint(0,10000)/100 #uniform btw 0 & 100
-		randn= random.normal(1, 0.2)
-		if rand < model.param('deathrate'): agent.die()
-		elif agent.wealth > model.param('breedThresh') * (randn if agent.breed=='rural' else agent.H/4):
+		rand = model.rng.integers(0,10000)/100 #uniform btw 0 & 100
+		randn= model.rng.normal(1, 0.2)
+		if rand < model.snapshot.deathrate: agent.die()
+		elif agent.wealth > model.snapshot.breedThresh * (randn if agent.breed=='rural' else agent.H/4):
 			child = agent.reproduce(
 				inherit=['H', ('wealth', lambda w: w[0]/2)],
 				mutate={'H': (0.5, 'log')}
@@ -118,26 +118,27 @@ def agentStep(agent, model, stage):
 	
 	#Get paid in modelStep, then pay rent
 	elif stage==2:
-		agent.wealth -= model.param('rent')/100 * agent.H + model.param('fixed')/100
+		agent.wealth -= model.snapshot.rent/100 * agent.H + model.snapshot.fixed/100
 		# agent.utils = agent.utility.calculate({'consumption': n})
 		if agent.wealth <= 0: agent.die()
 		return
 	
 heli.addHook('agentStep', agentStep)
 
-#Organize some data and pause if all agents are dead
+#Organize some data
 def modelPostStep(model):
-	if len(model.agents['agent']) == 0: model.gui.pause()
-	else:
-		for b in model.primitives['agent']['breeds']:
-			pop = len(model.agent(b))
-			if pop > 0:
-				setattr(model,'moverate'+b, model.movers[b]/pop)
-				setattr(model,'birthrate'+b, model.births[b]/pop)
-				model.movers[b] = 0
-				model.births[b] = 0
+	for b in model.primitives['agent']['breeds']:
+		pop = len(model.agent(b))
+		if pop > 0:
+			setattr(model,'moverate'+b, model.movers[b]/pop)
+			setattr(model,'birthrate'+b, model.births[b]/pop)
+			model.movers[b] = 0
+			model.births[b] = 0
 heli.addHook('modelPostStep', modelPostStep)
 
+#Stop if all agents are dead
+heli.data.stopWhen(lambda model: len(model.agents['agent']) == 0, 'All agents have died')
+
 def decideBreed(id, choices, model):
 	return 'rural';
 heli.addHook('decideBreed', decideBreed)
@@ -171,6 +172,8 @@ heli.data.addReporter('hsum', HSum)
 heli.data.addReporter('theta', lambda model: model.param('deathrate')/100)
 heli.addSeries('rates', 'theta', 'Death Rate', 'CCCCCC')
 
+heli.trackAttribute('H')		#Stored in arrays so the reporters below don't have to loop over agents
+heli.trackAttribute('wealth')
 for breed, d in heli.primitives['agent']['breeds'].items():
 	heli.data.addReporter(breed+'Pop', locals()[breed+'Pop'])
 	heli.data.addReporter(breed+'H', heli.data.agentReporter('H', 'agent', breed=breed, stat='gmean', percentiles=[25,75]))
@@ -185,4 +188,4 @@ for breed, d in heli.primitives['agent']['breeds'].items():
 	heli.addSeries('rates', breed+'moveRate', breed.title()+' Move Rate', d.color2)
 	heli.addSeries('rates', breed+'birthrate', breed.title()+' Birthrate', d.color)
 
-heli.launchGUI()
\ No newline at end of file
+if __name__ == '__main__': heli.launchGUI()
\ No newline at end of file
@@ -3,7 +3,6 @@
 
 from itertools import combinations
 from colour import Color
-import pandas
 
 from helipad import *
 from math import sqrt
@@ -40,14 +39,14 @@ class Store(baseAgent):
 		self.cashDemand = N * self.wage #Hold enough cash for one period's disbursements
 		newwage = (self.balance - self.cashDemand) / N
 		if newwage < 1: newwage = 1
-		self.wage = (self.wage * self.model.param('wStick') + newwage)/(1 + self.model.param('wStick'))
+		self.wage = (self.wage * self.model.snapshot.wStick + newwage)/(1 + self.model.snapshot.wStick)
 		if self.wage * N > self.balance: self.wage = self.balance / N 	#Budget constraint
 	
 		#Hire labor, with individualized wage shocks
 		labor = 0
 		for a in self.model.agents['agent']:
 			if self.wage < 0: self.wage = 0
-			wage = random.normal(self.wage, self.wage/2 + 0.1)	#Can't have zero stdev
+			wage = self.model.rng.normal(self.wage, self.wage/2 + 0.1)	#Can't have zero stdev
 			wage = 0 if wage < 0 else wage							#Wage bounded from below by 0
 			self.pay(a, wage)
 			labor += 1
@@ -58,8 +57,8 @@ class Store(baseAgent):
 
 			#Keep track of typical demand
 			#Target sufficient inventory to handle 1.5 standard deviations above mean demand for the last 50 periods
-			history = pandas.Series(self.model.data.getLast('demand-'+i, 50)) + pandas.Series(self.model.data.getLast('shortage-'+i, 50))
-			avg[i], stdev[i] = history.mean(), history.std()
+			history = self.model.data.rolling('totalDemand-'+i, 50)
+			avg[i], stdev[i] = (history.mean, history.std) if len(history) else (0, nan) #Empty before the first period's data, as getLast() was
 			itt = (1 if isnan(avg[i]) else avg[i]) + 1.5 * (1 if isnan(stdev[i]) else stdev[i])
 			self.invTarget[i] = (self.invTarget[i] + itt)/2 #Smooth it a bit
 		
@@ -72,12 +71,12 @@ class Store(baseAgent):
 			#Positive deltaInv indicates falling inventory; negative deltaInv rising inventory
 			lasti = self.model.data.getLast('inv-'+i,2)[0] if self.model.t > 1 else 0
 			deltaInv = lasti - self.goods[i]
-			self.price[i] *= (1 + deltaInv/(50 ** self.model.param('pSmooth')))
+			self.price[i] *= (1 + deltaInv/(50 ** self.model.snapshot.pSmooth))
 			if self.price[i] < 0: self.price[i] = 1
 		
 			#Produce stuff
-			self.portion[i] = (self.model.param('kImmob') * self.portion[i] + self.price[i]/tPrice) / (self.model.param('kImmob') + 1)	#Calculate capital allocation
-			self.goods[i] = self.goods[i] + self.portion[i] * labor * self.model.goodParam('prod',i)
+			self.portion[i] = (self.model.snapshot.kImmob * self.portion[i] + self.price[i]/tPrice) / (self.model.snapshot.kImmob + 1)	#Calculate capital allocation
+			self.goods[i] = self.goods[i] + self.portion[i] * labor * self.model.snapshot.goods.prod[i]
 	
 		#Intertemporal transactions
 		if hasattr(self, 'bank') and self.model.t > 0:
@@ -377,6 +376,7 @@ heli.addPlot('rr', 'Reserve Ratio', selected=False)
 heli.addPlot('i', 'Interest Rate', selected=False)
 
 heli.addSeries('capital', lambda t: 1/len(heli.primitives['agent']['breeds']), '', 'CCCCCC')
+heli.trackAttribute('expCons')	#Stored in an array so the reporters below don't have to loop over agents
 for breed, d in heli.primitives['agent']['breeds'].items():
 	heli.data.addReporter('rbalDemand-'+breed, rbaltodemand(breed))
 	heli.data.addReporter('eCons-'+breed, heli.data.agentReporter('expCons', 'agent', breed=breed, stat='sum'))
@@ -393,10 +393,17 @@ for breed, d in heli.primitives['agent']['breeds'].items():
 	heli.addSeries('capital', 'portion-'+AgentGoods[breed], AgentGoods[breed].title()+' Capital', heli.goods[AgentGoods[breed]].color)
 	# heli.addSeries('Wage', 'expWage', 'Expected Wage', '999999')
 
+#Everything customers tried to buy, whether or not they got it. Stores keep a 50-period window
+#of it to set their inventory targets.
+def totalDemand(good):
+	def total(model): return model.data.getLast('demand-'+good) + model.data.getLast('shortage-'+good)
+	return total
+
 #Do this one separately so it draws on top
 for good, g in heli.nonMoneyGoods.items():
 	heli.data.addReporter('inv-'+good, heli.data.agentReporter('goods', 'store', good=good))
 	heli.addSeries('inventory', 'inv-'+good, good.title()+' Inventory', g.color)
+	heli.data.rolling('totalDemand-'+good, 50, func=totalDemand(good))
 
 #Price ratio plots
 def ratioReporter(item1, item2):
@@ -635,17 +642,17 @@ heli.addHook('modelPostStep', modelPostStep)
 
 #Random shock to dwarf cash demand
 def shock(v):
-	c = random.normal(v, 4)
+	c = heli.rng.normal(v, 4)
 	return c if c >= 1 else 1
 heli.shocks.register('Dwarf real balances', 'rbd', shock, heli.shocks.randn(2), paramType='breed', obj='dwarf', prim='agent')
 
 #Shock the money supply
 def mshock(model):
 	# return v*2
-	pct = random.normal(1, 15)
+	pct = model.rng.normal(1, 15)
 	m = model.cb.M0 * (1+pct/100)
 	if m < 10000: m = 10000		#Things get weird when there's a money shortage
 	model.cb.M0 = m
 heli.shocks.register('M0 (2% prob)', None, mshock, heli.shocks.randn(2), desc="Shocks the money supply a random percentage (µ=1, σ=15) with 2% probability each period")
 
-heli.launchGUI()
\ No newline at end of file
+if __name__ == '__main__': heli.launchGUI()
\ No newline at end of file
@@ -41,6 +41,14 @@ def agentStep(agent, model, stage):
 	pass	
 heli.addHook('agentStep', agentStep)
 
+#Alternatively, agent logic can be written as array operations over the whole population. An agentStepVector
+#hook runs once per stage in place of agentStep, and receives columns of the attributes registered with
+#heli.trackAttribute(). Use frame.breed('name1') to get a mask of the agents of a breed.
+# heli.trackAttribute('myAgentProperty')
+# def agentStepVector(frame, model, stage):
+# 	frame['myAgentProperty'][frame.live] += 1
+# heli.addHook('agentStepVector', agentStepVector)
+
 #Any global code to be run each period should be hooked to modelStep, modelPreStep, or modelPostStep.
 #modelStep will run as many times per period as there are stages. modelPreStep and modelPostStep
 #will run at the beginning and end of each period, respectively, and do not take a stage argument.
@@ -7,14 +7,13 @@
 from helipad import Helipad
 from helipad.utility import CobbDouglas
 from math import sqrt, exp, floor
-import random
 
 heli = Helipad()
 heli.order = 'random'
 
 heli.addParameter('ratio', 'Log Endowment Ratio', 'slider', dflt=0, opts={'low': -3, 'high': 3, 'step': 0.5})
-heli.addGood('shmoo','11CC00', lambda breed: random.randint(1,1000))
-heli.addGood('soma', 'CC0000', lambda breed: random.randint(1,floor(exp(heli.param('ratio'))*1000)))
+heli.addGood('shmoo','11CC00', lambda breed: heli.random.randint(1,1000))
+heli.addGood('soma', 'CC0000', lambda breed: heli.random.randint(1,floor(exp(heli.param('ratio'))*1000)))
 
 #===============
 # BEHAVIOR
@@ -27,8 +26,8 @@ heli.addHook('agentInit', agentInit)
 
 def agentStep(agent, model, stage):
 	if agent.lastPeriod == model.t: return #Already traded
-	partner = random.choice(model.agents['agent']);
-	while partner.lastPeriod == model.t: partner = random.choice(model.agents['agent']) #Don't trade with someone who's already traded
+	partner = model.random.choice(model.agents['agent']);
+	while partner.lastPeriod == model.t: partner = model.random.choice(model.agents['agent']) #Don't trade with someone who's already traded
 	
 	myEndowU = agent.utility.calculate({'soma': agent.goods['soma'], 'shmoo': agent.goods['shmoo']})
 	theirEndowU = partner.utility.calculate({'soma': partner.goods['soma'], 'shmoo': partner.goods['shmoo']})
@@ -41,7 +40,7 @@ def agentStep(agent, model, stage):
 	cc2Shmoo = ((agent.goods['shmoo']+partner.goods['shmoo'])/(agent.goods['soma']+partner.goods['soma'])) * cc2Soma
 		
 	#Calculate demand: choose a random point on the contract curve
-	r = random.random()
+	r = model.random.random()
 	somaDemand = r*cc1Soma + (1-r)*cc2Soma - agent.goods['soma']
 	shmooDemand = r*cc1Shmoo + (1-r)*cc2Shmoo - agent.goods['shmoo']
 	
@@ -63,10 +62,7 @@ def agentStep(agent, model, stage):
 heli.addHook('agentStep', agentStep)
 
 #Stop the model when we're basically equilibrated
-def modelStep(model, stage):
-	if model.t > 1 and model.data.getLast('demand-shmoo') < 20 and model.data.getLast('demand-soma') < 20:
-		model.gui.terminate()
-heli.addHook('modelStep', modelStep)
+heli.data.stopWhen(lambda model: model.data.getLast('demand-shmoo') < 20 and model.data.getLast('demand-soma') < 20, 'Equilibrated')
 
 #===============
 # CONFIGURATION
@@ -78,4 +74,4 @@ heli.addSeries('price', 'ssprice', 'Soma/Shmoo Price', '119900')
 
 heli.defaultPlots = ['price', 'demand', 'utility']
 
-heli.launchGUI()
\ No newline at end of file
+if __name__ == '__main__': heli.launchGUI()
\ No newline at end of file
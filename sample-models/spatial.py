@@ -7,7 +7,6 @@
 #===============
 
 from helipad import *
-from random import randint
 
 heli = Helipad()
 heli.order = 'random'
@@ -52,7 +51,7 @@ heli.addPrimitive('patch', Patch, dflt=heli.dimension**2, low=0, high=100)
 
 #Randomly position our agents
 def baseAgentInit(agent, model):
-	agent.position = [randint(0, model.dimension-1), randint(0, model.dimension-1)]
+	agent.position = [model.random.randint(0, model.dimension-1), model.random.randint(0, model.dimension-1)]
 heli.addHook('baseAgentInit', baseAgentInit)
 
 #Both agents and patches to have x and y properties
@@ -122,4 +121,4 @@ heli.addHook('agentStep', agentStep)
 # LAUNCH THE GUI
 #===============
 
-heli.launchGUI(headless=False)
\ No newline at end of file
+if __name__ == '__main__': heli.launchGUI(headless=False)
\ No newline at end of file